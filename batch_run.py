@@ -0,0 +1,39 @@
+# Copyright 2020 (author: Meng Wu)
+
+import sys
+import argparse
+from src.pipeline import default_config
+from src.batch import correct_corpus
+
+
+def report(stats):
+    print("{utterances} utterances, {errors} errors, {seconds:.1f} s, {utt_per_sec:.1f} utt/s, " \
+            "{utt_per_sec_per_core:.1f} utt/s per core".format(**stats), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="correct a corpus of hypotheses offline")
+    parser.add_argument("input", help="Kaldi text file (utt_id w1 w2 ...) or FST archive (.far)")
+    parser.add_argument("output", help="corrected Kaldi text file, same order as input")
+    parser.add_argument("--conf", default="./conf", help="conf directory laid out like ./conf")
+    parser.add_argument("--cache", default="./graph_cache", help="compiled graph cache directory")
+    parser.add_argument("--fst-type", default="vector", choices=["vector", "const"], \
+                        help="const stores and loads static graphs as read-only ConstFst")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default all cores")
+    parser.add_argument("--input-type", default="auto", choices=["auto", "text", "far"])
+    parser.add_argument("--chunksize", type=int, default=16, help="utterances sent to a worker at once")
+    parser.add_argument("--progress-every", type=int, default=10000)
+    parser.add_argument("--candidates", action="store_true", help="per-request user graphs from the phonetic index")
+    args = parser.parse_args()
+
+    config = default_config(args.conf, args.cache)
+    config["fst_type"] = args.fst_type
+
+    stats = correct_corpus(config, args.input, args.output, workers=args.workers, \
+                            input_type=args.input_type, chunksize=args.chunksize, progress=report, \
+                            progress_every=args.progress_every, pipeline_opts={"candidates": args.candidates})
+    report(stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+# Copyright 2020 (author: Meng Wu)
@@ -0,0 +1,58 @@
+# Copyright 2020 (author: Meng Wu)
+"""
+    Per-utterance composition latency with a static graph whose arcs are not sorted,
+    against the same graph arcsorted once on its matching side (common.arcsort_static)
+    Usage:
+        python -m benchmark.bench_arcsort --num-words 200000 --utts 200
+"""
+
+import time
+import argparse
+from src.common import compose, arcsort_static
+from .generators import gen_lattice, gen_sigma_star, shuffle_arcs
+
+
+def latency(fn, hyps):
+    """
+        Return:
+            (mean, p50, p95) in ms
+    """
+    times = []
+    for hyp in hyps:
+        _start = time.time()
+        fn(hyp)
+        times.append((time.time() - _start) * 1000)
+    times.sort()
+
+    return sum(times) / len(times), times[len(times) // 2], times[int(len(times) * 0.95)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-words", type=int, default=200000)
+    parser.add_argument("--utts", type=int, default=200)
+    parser.add_argument("--depth", type=int, default=20)
+    parser.add_argument("--branching", type=int, default=3)
+    args = parser.parse_args()
+
+    hyps = [ gen_lattice(args.num_words, args.depth, args.branching, seed=i) for i in range(args.utts) ]
+    graph = shuffle_arcs(gen_sigma_star(args.num_words))
+
+    cases = [
+        ("hyp o G, G unsorted", lambda hyp: compose(hyp, graph)),
+        ("G o hyp, G unsorted", lambda hyp: compose(graph, hyp)),
+    ]
+    right = arcsort_static(graph.copy(), "ilabel")
+    left = arcsort_static(graph.copy(), "olabel")
+    cases += [
+        ("hyp o G, G ilabel sorted", lambda hyp: compose(hyp, right)),
+        ("G o hyp, G olabel sorted", lambda hyp: compose(left, hyp)),
+    ]
+
+    print("static graph: {} arcs, {} utterances".format(args.num_words, args.utts))
+    for name, fn in cases:
+        print("{:28s} mean {:8.3f} ms  p50 {:8.3f} ms  p95 {:8.3f} ms".format(name, *latency(fn, hyps)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Copyright 2020 (author: Meng Wu)
+"""
+    NE step latency per utterance as the user table grows:
+        cascade: hypothesis composed with fstG_subgraph o Lfst_invert, then with the full user_graph (as run.py)
+        precomposed: hypothesis composed with the NE cascade composed once (BrowniePipeline)
+        candidates: per-request user graph of the entries retrieved by the phonetic index (load_pipeline(candidates=True))
+    Usage:
+        python -m benchmark.bench_candidates --entries 100 1000 10000 --utts 200
+"""
+
+import os
+import time
+import random
+import argparse
+import tempfile
+from src.pipeline import default_config, build_graphs, BrowniePipeline
+from src.user_gram import TagHelper
+from src.user_ne import UserCustomGraph
+from src.common import get_result, read_string_as_fst
+from src.utils import DataIO, sym2int
+from .generators import write_vocab, write_lexicon, write_user_table
+from .bench_arcsort import latency
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--num-words", type=int, default=200, help="the precomposed cascade grows fast with it")
+    parser.add_argument("--utts", type=int, default=200)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    config = default_config()
+    config.update({"words": os.path.join(work_dir, "words.txt"), "lexicon": os.path.join(work_dir, "lexicon.txt"), \
+                    "grammar": os.path.join(work_dir, "grammar.txt")})
+    phones = [ ph for ph in DataIO().read_symbol_table(config["phones"]).keys() if ph[0].isalpha() and ph.isupper() ]
+    syllables = list(DataIO().read_file_to_dict(config["zh_syllable"]).keys())
+
+    words = write_vocab(config["words"], args.num_words)
+    with open(config["words"], "a") as f:
+        f.write("CALL {}\n".format(args.num_words + 3))
+    write_lexicon(config["lexicon"], words + [ "CALL" ], phones)
+    with open(config["grammar"], "w") as f:
+        f.write("<SIGMA_STAR> CALL <CONTACT> <SIGMA_STAR> </CONTACT> </s>\n")
+    helper = TagHelper(config["words"], config["phones"], config["jieba_lex"])
+
+    for num_entries in args.entries:
+        user_table = os.path.join(work_dir, "user_table.{}.txt".format(num_entries))
+        phrases = write_user_table(user_table, words, phones, syllables, num_entries)
+        _start = time.time()
+        graphs = build_graphs(config["words"], config["phones"], config["lexicon"], config["grammar"], user_table, \
+                                config["zh_syllable"], jieba_lex=config["jieba_lex"], helper=helper, work_dir=work_dir)
+        graph_time = time.time() - _start
+
+        rng = random.Random(0)
+        # half of the utterances call a user entry, the others two random words
+        hyps = [ read_string_as_fst(sym2int("<s> CALL {} </s>".format(rng.choice(phrases) if i % 2 == 0 \
+                    else " ".join(rng.sample(words, 2))), graphs["words_user"])) for i in range(args.utts) ]
+
+        _start = time.time()
+        full = BrowniePipeline.from_graphs(graphs, helper)
+        full_time = time.time() - _start
+        _start = time.time()
+        user_custom = UserCustomGraph(user_table, graphs["words_tag"], config["phones"], config["zh_syllable"], \
+                                        jieba_lex=config["jieba_lex"])
+        candidates = BrowniePipeline.from_graphs(graphs, helper, user_custom=user_custom)
+        candidates_time = time.time() - _start
+
+        cases = [
+            ("cascade", graph_time, lambda hyp: get_result(hyp, candidates.ne_left, graphs["user_graph"])),
+            ("precomposed", graph_time + full_time, lambda hyp: get_result(hyp, full.ne_graph)),
+            ("candidates", graph_time + candidates_time, candidates.candidate_result),
+        ]
+        for name, build_time, fn in cases:
+            print("{:6d} entries, {:12s} build {:7.2f} s  mean {:8.3f} ms  p50 {:8.3f} ms  p95 {:8.3f} ms".format( \
+                    num_entries, name, build_time, *latency(fn, hyps)))
+        stats = user_custom.index.stats
+        print("{:6d} entries, {:.1f} candidates per utterance".format(num_entries, stats["retrieved"] / max(stats["queries"], 1)))
+
+
+if __name__ == "__main__":
+    main()
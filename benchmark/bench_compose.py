@@ -0,0 +1,36 @@
+# Copyright 2020 (author: Meng Wu)
+"""
+    Emptiness check inside src.common.compose: fst.print() != "" against is_empty()
+    Usage:
+        python -m benchmark.bench_compose --depth 1000 --branching 20
+"""
+
+import argparse
+import timeit
+import pynini
+from src.common import is_empty
+from .generators import gen_lattice, gen_sigma_star
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-words", type=int, default=5000)
+    parser.add_argument("--depth", type=int, default=1000)
+    parser.add_argument("--branching", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    lattice = gen_lattice(args.num_words, args.depth, args.branching)
+    fst = pynini.compose(lattice, gen_sigma_star(args.num_words))
+    num_arcs = sum(fst.num_arcs(state) for state in fst.states())
+    print("composed lattice: {} states, {} arcs".format(fst.num_states(), num_arcs))
+
+    t_print = timeit.timeit(lambda: fst.print() != "", number=args.repeat) / args.repeat
+    t_check = timeit.timeit(lambda: not is_empty(fst), number=args.repeat) / args.repeat
+    print("print() check:   {:.3f} ms".format(t_print * 1000))
+    print("is_empty check:  {:.6f} ms".format(t_check * 1000))
+    print("speedup:         {:.0f}x".format(t_print / t_check))
+
+
+if __name__ == "__main__":
+    main()
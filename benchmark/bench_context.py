@@ -0,0 +1,202 @@
+# Copyright 2020 (author: Meng Wu)
+"""
+    context lexicon compile time, string lists (make_context_fst + list2fst)
+    against numeric arc buffers (make_context_arrays + arrays2fst)
+    Usage:
+        python -m benchmark.bench_context --num-entries 100000
+"""
+
+import math
+import time
+import random
+import argparse
+from array import array
+from src.utils import SymbolTable
+from src.common import arrays2fst, fst_size
+
+
+# the served context graphs are built by UserCustomGraph (shared passthrough and hotword paths),
+# the context lexicon builders below are only kept here to compare string lists with arc buffers
+
+
+def make_context_fst(x, weight=True):
+    """
+    read a Kaldi lexicon format list.
+        <word1> <weight> <sub-word1> <sub-word2> <...>
+        example:
+            ABABA 1.0 ABABA
+            ABACHA 1.0 ABACHA
+            每日一物 100 每 日 一 物
+            每日一物 100 每日 一物
+    Returns:
+        List with FST format.
+    """
+    C = x
+    C_fst = []
+    state = int(0)
+    if weight:
+        for i in range(len(C)):
+            if len(C[i]) == 3:
+                logprob = '%.10f' % (-math.log(float(C[i][1])))
+                C_fst.append(['0', '0', C[i][2], C[i][0], logprob])
+            else:
+                logprob = '%.10f' % (-math.log(float(C[i][1])))
+                for j in range(len(C[i]) - 2):
+                    if j == 0:
+                        C_fst.append(['0', '%s' %  (state + 1), C[i][j+2], C[i][0], logprob])
+                        state = state + 1
+                    elif j == len(C[i]) - 3:
+                        C_fst.append(['%s' % state, '0', C[i][j+2], '<eps>'])
+                    else:
+                        C_fst.append(['%s' % state, '%s' % (state + 1), C[i][j+2], '<eps>'])
+                        state = state + 1
+        C_fst.append(['0','0']) # add end
+    
+    else:
+        for i in range(len(C)):
+            if len(C[i]) == 3:
+                C_fst.append(['0', '0', C[i][2], C[i][0]])
+            else:
+                for j in range(len(C[i]) - 2):
+                    if j == 0:
+                        C_fst.append(['0', '%s' %  (state + 1), C[i][j+2], C[i][0]])
+                        state = state + 1
+                    elif j == len(C[i]) - 3:
+                        C_fst.append(['%s' % state, '0', C[i][j+2], '<eps>'])
+                    else:
+                        C_fst.append(['%s' % state, '%s' % (state + 1), C[i][j+2], '<eps>'])
+                        state = state + 1
+        C_fst.append(['0','0']) # add end
+
+    return C_fst
+
+
+def make_context_arrays(x, in_syms, out_syms, weight=True):
+    """
+        numeric version of make_context_fst, same lexicon list input.
+        Labels are looked up here and arcs are kept in array.array buffers for common.arrays2fst.
+        Input:
+            in_syms, out_syms: SymbolTable
+        Return:
+            num_states: int
+            arcs: tuple of array.array (src, dst, ilabel, olabel, weight)
+    """
+    src, dst, ilabel, olabel = array("l"), array("l"), array("l"), array("l")
+    weights = array("d")
+    logprobs = {}
+    eps = out_syms["<eps>"]
+    state = 0
+    for entry in x:
+        out_label = out_syms[entry[0]]
+        if entry[1] not in logprobs:
+            logprobs[entry[1]] = -math.log(float(entry[1])) if weight else 0.
+        logprob = logprobs[entry[1]]
+
+        if len(entry) == 3:
+            src.append(0)
+            dst.append(0)
+            ilabel.append(in_syms[entry[2]])
+            olabel.append(out_label)
+            weights.append(logprob)
+            continue
+
+        # 0 -> state + 1 -> ... -> 0, output and weight on the first arc
+        num_sub_words = len(entry) - 2
+        src.append(0)
+        src.extend(range(state + 1, state + num_sub_words))
+        dst.extend(range(state + 1, state + num_sub_words))
+        dst.append(0)
+        ilabel.extend([ in_syms[sub_word] for sub_word in entry[2:] ])
+        olabel.append(out_label)
+        olabel.extend([eps] * (num_sub_words - 1))
+        weights.append(logprob)
+        weights.extend([0.] * (num_sub_words - 1))
+        state += num_sub_words - 1
+
+    return state + 1, (src, dst, ilabel, olabel, weights)
+
+
+def list2fst(x, in_syms, out_syms):
+    """
+        Input:
+            x is like:
+                [['0', '1', '世界', '世博會', '0.1053605157'], ['1', '0', '博覽會', '<eps>'],
+                ['0', '2', '一個', '一個巨星的誕生', '0.1053605157'], ['2', '3', '巨星', '<eps>'],
+                ['3', '4', '的', '<eps>'], ['4', '0', '誕生', '<eps>']]
+            in_syms, out_syms is SymbolTable
+        Return:
+            Fst
+    """
+    if x is None:
+        raise ValueError("empty fst list")
+
+    src, dst, ilabel, olabel = array("l"), array("l"), array("l"), array("l")
+    weight = array("d")
+    finals = []
+    for i in x:
+        if len(i) == 5 or len(i) == 4:
+            src.append(int(i[0]))
+            dst.append(int(i[1]))
+            ilabel.append(in_syms[i[2]])
+            olabel.append(out_syms[i[3]])
+            weight.append(float(i[4]) if len(i) == 5 else 0.)
+        else:
+            # end mark of make_context_fst
+            finals = [0]
+
+    return arrays2fst(src, dst, ilabel, olabel, weight, finals=finals).optimize()
+
+
+def gen_context_lex(num_entries, hot_ratio=0.1, seed=0):
+    """
+        Return:
+            lexicon list as make_context_fst() input, SymbolTable of all its words
+    """
+    rng = random.Random(seed)
+    syms = SymbolTable({"<eps>": 0})
+    lex = []
+    for i in range(num_entries):
+        word = "W{}".format(i)
+        syms.add_symbol(word)
+        if rng.random() < hot_ratio:
+            # hotword spelled by 2 ~ 4 vocabulary words
+            sub_words = [ "W{}".format(rng.randint(0, num_entries - 1)) for _ in range(rng.randint(2, 4)) ]
+            lex.append([word, "0.9"] + sub_words)
+        else:
+            lex.append([word, "0.1", word])
+
+    return lex, syms
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-entries", type=int, default=100000)
+    parser.add_argument("--hot-ratio", type=float, default=0.1)
+    args = parser.parse_args()
+
+    lex, syms = gen_context_lex(args.num_entries, args.hot_ratio)
+
+    _start = time.time()
+    context_list = make_context_fst(lex)
+    _lists = time.time()
+    fst_old = list2fst(context_list, syms, syms)
+    _end = time.time()
+    print("string lists:   make_context_fst {:.3f} s, list2fst {:.3f} s (with optimize), total {:.3f} s".format( \
+            _lists - _start, _end - _lists, _end - _start))
+
+    _start = time.time()
+    num_states, arcs = make_context_arrays(lex, syms, syms)
+    _arrays = time.time()
+    fst_new = arrays2fst(*arcs, num_states=num_states)
+    _compile = time.time()
+    fst_new.optimize()
+    _end = time.time()
+    print("arc buffers:    make_context_arrays {:.3f} s, arrays2fst {:.3f} s, optimize {:.3f} s, total {:.3f} s".format( \
+            _arrays - _start, _compile - _arrays, _end - _compile, _end - _start))
+
+    print("entries: {}, arcs: {}, optimized: {} / {} (states / arcs)".format(args.num_entries, len(arcs[0]), \
+            fst_size(fst_old), fst_size(fst_new)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+# Copyright 2020 (author: Meng Wu)
+"""
+    L.fst construction time of GrammarHelper.build_lexicon on a synthetic lexicon
+    Usage:
+        python -m benchmark.bench_lexicon --num-words 160000
+"""
+
+import os
+import argparse
+import tempfile
+from src.utils import DataIO
+from src.user_gram import GrammarHelper
+from .generators import write_vocab, write_lexicon
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-words", type=int, default=160000)
+    parser.add_argument("--phones", default="conf/phones.txt")
+    args = parser.parse_args()
+
+    phones = [ ph for ph in DataIO().read_word_table(args.phones).keys() if ph != "<eps>" and not ph.startswith("#") ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        words_path = os.path.join(tmp_dir, "words.txt")
+        lex_path = os.path.join(tmp_dir, "lexicon.txt")
+        write_lexicon(lex_path, write_vocab(words_path, args.num_words), phones)
+
+        helper = GrammarHelper(words_path, args.phones)
+        helper.build_lexicon(lex_path, directions=("lfst", "invert"))
+        stats = helper.lex_build_stats
+        print("entries:     {}".format(args.num_words))
+        print("read:        {:.3f} s".format(stats["read_time"]))
+        print("build:       {:.3f} s".format(stats["build_time"]))
+        print("raw fst:     {} states, {} arcs".format(stats["raw_states"], stats["raw_arcs"]))
+        print("optimized:   {} states, {} arcs".format(stats["states"], stats["arcs"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# Copyright 2020 (author: Meng Wu)
+"""
+    Latency after end of speech of streaming correction against correcting the finished hypothesis:
+        batch: process_text() of the whole hypothesis once </s> is known
+        streaming: words are pushed as they arrive, only finish() runs after end of speech
+    The mean time of one push() is reported too, it is spent while the user is still speaking.
+    Usage:
+        python -m benchmark.bench_streaming --utts 200
+"""
+
+import time
+import random
+import argparse
+from src.pipeline import default_config, load_pipeline
+from .bench_arcsort import latency
+
+
+SENTENCES = ["CALL EMMA ROSE", "TEXT 世界 博覽會", "A ROSE", "CALL AN A ROSE", "CALL 一個 巨星 的 誕生", \
+                "TEXT 一個 EMMA ROSE 世界 博覽會", "EMMA CALL EMMA ROSE"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--utts", type=int, default=200)
+    parser.add_argument("--conf", default="./conf")
+    parser.add_argument("--cache", default="./graph_cache")
+    args = parser.parse_args()
+
+    config = default_config(args.conf, args.cache)
+    rng = random.Random(0)
+    utts = [ rng.choice(SENTENCES).split() for _ in range(args.utts) ]
+
+    for name, kwargs in [("precomposed", {}), ("lazy", {"lazy": True}), ("candidates", {"candidates": True})]:
+        pipeline = load_pipeline(config, **kwargs)
+        stream = pipeline.streaming()
+        push_times = []
+
+        def streaming(words):
+            stream.reset()
+            for word in words:
+                _start = time.time()
+                stream.push([word])
+                push_times.append(time.time() - _start)
+            _start = time.time()
+            stream.finish()
+
+            return time.time() - _start
+
+        finish_times = sorted(streaming(words) * 1000 for words in utts)
+        print("{:12s} batch     after end of speech mean {:8.3f} ms  p50 {:8.3f} ms  p95 {:8.3f} ms".format( \
+                name, *latency(lambda words: pipeline.process_text("<s> {} </s>".format(" ".join(words))), utts)))
+        print("{:12s} streaming after end of speech mean {:8.3f} ms  p50 {:8.3f} ms  p95 {:8.3f} ms, " \
+                "{:.3f} ms per push".format(name, sum(finish_times) / len(finish_times), finish_times[len(finish_times) // 2], \
+                finish_times[int(len(finish_times) * 0.95)], sum(push_times) / len(push_times) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# Copyright 2020 (author: Meng Wu)
+
+import io
+import random
+import pynini
+
+
+def gen_lattice(num_words=1000, depth=100, branching=10, seed=0):
+    """
+        random word lattice, each of depth steps has branching parallel arcs
+        Input:
+            num_words: labels are drawn from 1 ~ num_words
+        Return:
+            pynini.Fst with depth * branching arcs
+    """
+    rng = random.Random(seed)
+    fst = pynini.Fst()
+    fst.add_states(depth + 1)
+    for state in range(depth):
+        for _ in range(branching):
+            label = rng.randint(1, num_words)
+            fst.add_arc(state, pynini.Arc(label, label, rng.random(), state + 1))
+
+    fst.set_start(0)
+    fst.set_final(depth)
+
+    return fst
+
+
+def gen_sigma_star(num_words=1000):
+    """
+        one-state identity acceptor over 1 ~ num_words
+    """
+    fst = pynini.Fst()
+    fst.add_state()
+    for label in range(1, num_words + 1):
+        fst.add_arc(0, pynini.Arc(label, label, 0, 0))
+
+    fst.set_start(0)
+    fst.set_final(0)
+
+    return fst
+
+
+def write_vocab(path, num_words=10000, prefix="W"):
+    """
+        Kaldi words.txt with <eps>, <s>, </s> and num_words synthetic words
+        Return:
+            list of words
+    """
+    words = [ "{}{:06d}".format(prefix, i) for i in range(num_words) ]
+    with io.open(path, "w", encoding="utf-8") as f:
+        f.write("<eps> 0\n")
+        for idx, wd in enumerate(words):
+            f.write("{} {}\n".format(wd, idx + 1))
+        f.write("<s> {}\n</s> {}\n".format(num_words + 1, num_words + 2))
+
+    return words
+
+
+def write_lexicon(path, words, phones, min_len=2, max_len=6, seed=0):
+    """
+        Kaldi lexicon.txt, each word has one random pronunciation
+        Input:
+            phones: list of phone symbols
+    """
+    rng = random.Random(seed)
+    with io.open(path, "w", encoding="utf-8") as f:
+        f.write("<s> SIL\n</s> SIL\n")
+        for wd in words:
+            f.write("{} {}\n".format(wd, " ".join(rng.choice(phones) for _ in range(rng.randint(min_len, max_len)))))
+
+
+def shuffle_arcs(x, seed=0):
+    """
+        copy of x with arcs of every state in random order, like a graph built without arcsort
+    """
+    rng = random.Random(seed)
+    fst = x.copy()
+    for state in fst.states():
+        arcs = list(fst.arcs(state))
+        rng.shuffle(arcs)
+        fst.delete_arcs(state)
+        for arc in arcs:
+            fst.add_arc(state, arc)
+
+    return fst
+
+
+def write_user_table(path, words, phones, syllables, num_entries=1000, seed=0):
+    """
+        user_table.txt like a phone book, each entry is a two-word phrase with a random IPA string
+        and a random SoundsLike, displayed as a new word NAME<i>
+        Input:
+            words: vocabulary the phrases are drawn from
+            syllables: list of zh_syllable.txt syllables
+        Return:
+            list of phrases
+    """
+    rng = random.Random(seed)
+    phrases = []
+    with io.open(path, "w", encoding="utf-8") as f:
+        f.write("Phrase,SoundsLike,IPA,DisplayAs\n")
+        for i in range(num_entries):
+            phrase = " ".join(rng.sample(words, 2))
+            soundslike = "-".join(rng.choice(syllables) for _ in range(rng.randint(2, 3)))
+            ipa = " ".join(rng.choice(phones) for _ in range(rng.randint(4, 8)))
+            f.write("{},{},{},NAME{:06d}\n".format(phrase, soundslike, ipa, i))
+            phrases.append(phrase)
+
+    return phrases
+
+
+def write_grammar(path, triggers, slot="CONTACT"):
+    """
+        grammar.txt with one rule per trigger word: <SIGMA_STAR> trigger <slot> <SIGMA_STAR> </slot> </s>
+    """
+    with io.open(path, "w", encoding="utf-8") as f:
+        for trigger in triggers:
+            f.write("<SIGMA_STAR> {} <{}> <SIGMA_STAR> </{}> </s>\n".format(trigger, slot, slot))
+
+
+def gen_hyp_lattice(syms, triggers, phrases, words, depth=4, branching=3, seed=0):
+    """
+        hypothesis lattice like "<s> trigger w1 ... wn </s>", the slot is a user phrase on one path
+        and depth positions of branching random words on the others
+        Input:
+            syms: SymbolTable
+            triggers, phrases, words: lists of strings, phrases are space separated words
+        Return:
+            pynini.Fst
+    """
+    rng = random.Random(seed)
+    phrase = rng.choice(phrases).split()
+    fst = pynini.Fst()
+    fst.add_states(depth + 4)
+    fst.set_start(0)
+    fst.add_arc(0, pynini.Arc(syms["<s>"], syms["<s>"], 0, 1))
+    trigger = syms[rng.choice(triggers)]
+    fst.add_arc(1, pynini.Arc(trigger, trigger, 0, 2))
+
+    # the phrase is the best path through its own states
+    cur_state = 2
+    for i, wd in enumerate(phrase):
+        next_state = depth + 2 if i == len(phrase) - 1 else fst.add_state()
+        fst.add_arc(cur_state, pynini.Arc(syms[wd], syms[wd], 0, next_state))
+        cur_state = next_state
+
+    for state in range(2, depth + 2):
+        for _ in range(branching):
+            label = syms[rng.choice(words)]
+            fst.add_arc(state, pynini.Arc(label, label, 1 + rng.random(), state + 1))
+
+    fst.add_arc(depth + 2, pynini.Arc(syms["</s>"], syms["</s>"], 0, depth + 3))
+    fst.set_final(depth + 3)
+
+    return fst
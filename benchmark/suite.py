@@ -0,0 +1,246 @@
+# Copyright 2020 (author: Meng Wu)
+"""
+    Benchmark of every pipeline stage on synthetic data at production scale:
+        graph build time, size and peak RSS (lexicon, grammars, user graphs),
+        per-utterance latency percentiles of each correction step (as run.py) and throughput.
+    Data are generated from fixed seeds, results are written as JSON and can be compared
+    with a previous run to catch regressions.
+    Usage:
+        python -m benchmark.suite --scale medium --json bench.json
+        python -m benchmark.suite --scale medium --compare bench.json --tolerance 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import pynini
+from src.user_gram import TagHelper
+from src.user_ne import UserCustomGraph
+from src.pipeline import sort_graphs
+from src.common import compose, union, get_result, fst_size, fst_labels, compose_stats
+from src.utils import DataIO
+from .generators import write_vocab, write_lexicon, write_grammar, write_user_table, gen_hyp_lattice
+
+
+# (vocabulary, user table entries)
+SCALES = {
+    "small": (10000, 1000),
+    "medium": (100000, 10000),
+    "large": (500000, 100000),
+}
+
+# changes below these values are timer noise, not regressions
+NOISE_FLOOR = {"seconds": 0.05, "peak_rss_mb": 10, "p50_ms": 0.1, "p90_ms": 0.1}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return rss / (1 << 20) if sys.platform == "darwin" else rss / 1024
+
+
+def percentiles(times):
+    """
+        Input:
+            times: list of seconds
+        Return:
+            dict of mean, p50, p90, p99 and max in ms
+    """
+    times = sorted(times)
+
+    def at(q):
+        return times[min(int(len(times) * q), len(times) - 1)] * 1000
+
+    return {"mean_ms": sum(times) / len(times) * 1000, "p50_ms": at(0.5), "p90_ms": at(0.9), "p99_ms": at(0.99), \
+            "max_ms": times[-1] * 1000}
+
+
+class StageTimer():
+    """
+        time build stages and keep their size and peak RSS
+    """
+    def __init__(self):
+        self.results = {}
+
+    def run(self, name, fn):
+        _start = time.time()
+        result = fn()
+        seconds = time.time() - _start
+        self.results[name] = {"seconds": seconds, "peak_rss_mb": peak_rss_mb()}
+        if isinstance(result, pynini.Fst):
+            self.results[name]["states"], self.results[name]["arcs"] = fst_size(result)
+        print("build {:18s} {:8.2f} s  {:8.0f} MB".format(name, seconds, self.results[name]["peak_rss_mb"]), file=sys.stderr)
+
+        return result
+
+
+def generate(work_dir, args):
+    """
+        write words.txt, lexicon.txt, grammar.txt and user_table.txt of the requested scale into work_dir
+        Return:
+            dict of file paths and the generated words, triggers and phrases
+    """
+    conf = {"phones": os.path.join(args.conf, "phones.txt"), "zh_syllable": os.path.join(args.conf, "zh_syllable.txt"), \
+            "jieba_lex": os.path.join(args.conf, "jieba.lex.txt"), "words": os.path.join(work_dir, "words.txt"), \
+            "lexicon": os.path.join(work_dir, "lexicon.txt"), "grammar": os.path.join(work_dir, "grammar.txt"), \
+            "user_table": os.path.join(work_dir, "user_table.txt")}
+    phones = [ ph for ph in DataIO().read_symbol_table(conf["phones"]).keys() if ph[0].isalpha() and ph.isupper() ]
+    syllables = list(DataIO().read_file_to_dict(conf["zh_syllable"]).keys())
+
+    words = write_vocab(conf["words"], args.num_words)
+    write_lexicon(conf["lexicon"], words, phones, seed=args.seed)
+    triggers = words[:args.num_triggers]
+    write_grammar(conf["grammar"], triggers)
+    phrases = write_user_table(conf["user_table"], words[args.num_triggers:], phones, syllables, args.entries, seed=args.seed)
+    conf.update({"word_list": words, "triggers": triggers, "phrases": phrases})
+
+    return conf
+
+
+def build(conf, timer, sigma="expand"):
+    """
+        build all graphs stage by stage as build_graphs() does
+    """
+    helper = timer.run("helper", lambda: TagHelper(conf["words"], conf["phones"], conf["jieba_lex"], sigma=sigma))
+    lex_fsts = timer.run("lexicon", lambda: helper.build_lexicon(conf["lexicon"], add_opt_sil="SIL", directions=("lfst", "invert")))
+    graphs = {"Lfst": lex_fsts["lfst"], "Lfst_invert": lex_fsts["invert"]}
+    graphs["fstG"] = timer.run("tag_grammar", lambda: helper.read_tag_grammar(conf["grammar"]))
+    graphs["fstG_subgraph"] = timer.run("sub_graph_grammar", lambda: helper.read_sub_graph_grammar(conf["grammar"]))
+
+    words_tag = helper.word_tb.copy()
+    helperU = timer.run("user_table", lambda: UserCustomGraph(conf["user_table"], words_tag, conf["phones"], \
+                                                                conf["zh_syllable"], jieba_lex=conf["jieba_lex"]))
+    fstC = timer.run("contextFST", helperU.contextFST)
+    fstS = timer.run("soundslikeFST", helperU.soundslikeFST)
+    fstI = timer.run("ipaFST", helperU.ipaFST)
+    graphs["user_graph"] = timer.run("user_graph", lambda: union(compose(graphs["Lfst"], fstC), fstS, fstI))
+    timer.run("phonetic_index", helperU.build_index)
+    graphs["words_user"] = helperU.word_table()
+
+    return helper, sort_graphs(graphs)
+
+
+def correct(hyps, helper, graphs):
+    """
+        correct each hypothesis step by step as BrowniePipeline.process() does,
+        compact sigma-star arcs are specialized the same way so --sigma compact times real corrections
+        Return:
+            dict {step: list of seconds}
+    """
+    times = {"tag": [], "ne": [], "replace": [], "result": [], "total": []}
+    fstG_subgraph = helper.specialize(graphs["fstG_subgraph"], helper.sigma_ids)
+    for hyp in hyps:
+        _start = time.time()
+        tag_hyp = compose(hyp, helper.specialize(graphs["fstG"], fst_labels(hyp, "output")))
+        _tag = time.time()
+        ne_result = get_result(hyp, fstG_subgraph, graphs["Lfst_invert"], graphs["user_graph"])
+        _ne = time.time()
+        Rfst = helper.generate_replace_fst(ne_result, nonterminal_in="<CONTACT>", nonterminal_out="</CONTACT>", \
+                                            syms_tb=graphs["words_user"])
+        Rfst = helper.specialize(Rfst, fst_labels(tag_hyp, "output"))
+        _replace = time.time()
+        get_result(tag_hyp, Rfst)
+        _end = time.time()
+
+        times["tag"].append(_tag - _start)
+        times["ne"].append(_ne - _tag)
+        times["replace"].append(_replace - _ne)
+        times["result"].append(_end - _replace)
+        times["total"].append(_end - _start)
+
+    return times
+
+
+def compare(report, baseline, tolerance):
+    """
+        Return:
+            list of (metric, baseline value, value) which are worse than baseline by more than tolerance
+    """
+    regressions = []
+    for section, key in [("build", "seconds"), ("build", "peak_rss_mb"), ("latency", "p50_ms"), ("latency", "p90_ms")]:
+        for name, values in report[section].items():
+            old = baseline.get(section, {}).get(name, {}).get(key)
+            if old is not None and values[key] > old * (1 + tolerance) and values[key] - old > NOISE_FLOOR[key]:
+                regressions.append(("{}.{}.{}".format(section, name, key), old, values[key]))
+
+    old = baseline.get("throughput_utt_per_sec")
+    if old is not None and report["throughput_utt_per_sec"] < old * (1 - tolerance):
+        regressions.append(("throughput_utt_per_sec", old, report["throughput_utt_per_sec"]))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark all Brownie stages on synthetic data")
+    parser.add_argument("--scale", default="small", choices=sorted(SCALES.keys()))
+    parser.add_argument("--num-words", type=int, default=None, help="vocabulary size, overrides --scale")
+    parser.add_argument("--entries", type=int, default=None, help="user table entries, overrides --scale")
+    parser.add_argument("--num-triggers", type=int, default=2, help="grammar rules, one trigger word each")
+    parser.add_argument("--utts", type=int, default=500)
+    parser.add_argument("--depth", type=int, default=4, help="slot positions of hypothesis lattices")
+    parser.add_argument("--branching", type=int, default=3, help="competing words per slot position")
+    parser.add_argument("--sigma", default="expand", choices=["expand", "compact"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--conf", default="./conf", help="phones.txt, zh_syllable.txt and jieba.lex.txt are read from it")
+    parser.add_argument("--json", default=None, help="write the report here, - for stdout")
+    parser.add_argument("--compare", default=None, help="report JSON of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown in --compare")
+    args = parser.parse_args()
+
+    num_words, entries = SCALES[args.scale]
+    args.num_words = args.num_words or num_words
+    args.entries = args.entries or entries
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        conf = generate(work_dir, args)
+        timer = StageTimer()
+        helper, graphs = build(conf, timer, sigma=args.sigma)
+
+    syms = graphs["words_user"]
+    hyps = [ gen_hyp_lattice(syms, conf["triggers"], conf["phrases"], conf["word_list"], depth=args.depth, \
+                                branching=args.branching, seed=args.seed + i) for i in range(args.utts) ]
+    compose_stats.update({"calls": 0, "unsorted": 0})
+    times = correct(hyps, helper, graphs)
+
+    report = {
+        "config": {key: getattr(args, key) for key in ["scale", "num_words", "entries", "num_triggers", "utts", \
+                                                        "depth", "branching", "sigma", "seed"]},
+        "env": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "build": timer.results,
+        "latency": {step: percentiles(step_times) for step, step_times in times.items()},
+        "throughput_utt_per_sec": len(hyps) / sum(times["total"]),
+        "compose": dict(compose_stats),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+    for step, values in report["latency"].items():
+        print("{:8s} mean {mean_ms:8.3f} ms  p50 {p50_ms:8.3f} ms  p90 {p90_ms:8.3f} ms  p99 {p99_ms:8.3f} ms".format( \
+                step, **values), file=sys.stderr)
+    print("{:.1f} utt/s, peak RSS {:.0f} MB".format(report["throughput_utt_per_sec"], report["peak_rss_mb"]), file=sys.stderr)
+
+    if args.json == "-":
+        print(json.dumps(report, indent=2))
+    elif args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            print("warning: baseline was run with another config {}".format(baseline.get("config")), file=sys.stderr)
+        regressions = compare(report, baseline, args.tolerance)
+        for metric, old, new in regressions:
+            print("regression {}: {:.3f} -> {:.3f}".format(metric, old, new), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
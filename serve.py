@@ -0,0 +1,38 @@
+# Copyright 2020 (author: Meng Wu)
+
+import asyncio
+import argparse
+from src.pipeline import default_config
+from src.server import BrownieServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Brownie correction server")
+    parser.add_argument("--conf", default="./conf", help="conf directory laid out like ./conf")
+    parser.add_argument("--cache", default="./graph_cache", help="compiled graph cache directory")
+    parser.add_argument("--fst-type", default="vector", choices=["vector", "const"], \
+                        help="const stores and loads static graphs as read-only ConstFst")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--unix-socket", default=None, help="listen on this Unix socket instead of host:port")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default all cores")
+    parser.add_argument("--max-batch", type=int, default=16)
+    parser.add_argument("--max-wait-ms", type=float, default=5.)
+    parser.add_argument("--max-pending", type=int, default=1024, help="queued requests before rejecting with 503")
+    parser.add_argument("--candidates", action="store_true", help="per-request user graphs from the phonetic index")
+    args = parser.parse_args()
+
+    config = default_config(args.conf, args.cache)
+    config["fst_type"] = args.fst_type
+
+    server = BrownieServer(config, workers=args.workers, max_batch=args.max_batch, \
+                            max_wait=args.max_wait_ms / 1000, max_pending=args.max_pending, \
+                            pipeline_opts={"candidates": args.candidates})
+    try:
+        asyncio.run(server.serve(host=args.host, port=args.port, unix_socket=args.unix_socket))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+if __name__ == "__main__":
+    main()
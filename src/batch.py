@@ -0,0 +1,123 @@
+# Copyright 2020 (author: Meng Wu)
+
+import io
+import os
+import time
+import multiprocessing
+import pynini
+from .pipeline import load_pipeline
+from .common import fst_to_linear_sequence
+from .utils import DataIO, int2sym
+
+# pipeline of this process, inherited from the parent when workers are forked
+_worker = {}
+
+
+def worker_init(config, pipeline_opts):
+    """
+        pool initializer, only loads graphs (from GraphCache) if they are not inherited by fork
+    """
+    if "pipeline" not in _worker:
+        _worker["pipeline"] = load_pipeline(config, **pipeline_opts)
+
+
+def worker_process(item):
+    """
+        Input:
+            item: (utt_id, hypothesis string or serialized fst)
+        Return:
+            (utt_id, corrected string, error message or None), hypothesis string is kept if correction failed
+    """
+    utt_id, hyp = item
+    pipeline = _worker["pipeline"]
+    try:
+        if isinstance(hyp, bytes):
+            result = pipeline.process(pynini.Fst.read_from_string(hyp))
+            return utt_id, int2sym(fst_to_linear_sequence(result), pipeline.syms_tb), None
+        else:
+            return utt_id, pipeline.process_text(hyp), None
+
+    except Exception as e:
+        return utt_id, hyp if isinstance(hyp, str) else "", "{}: {}".format(type(e).__name__, e)
+
+
+def read_kaldi_text(x):
+    """
+        Kaldi text file, "utt_id w1 w2 ..." per line
+        Return:
+            iterator of (utt_id, hypothesis string)
+    """
+    for line in DataIO().iter_file_lines(x):
+        if line[0] != "":
+            yield line[0], " ".join(line[1:])
+
+
+def read_far(x):
+    """
+        Return:
+            iterator of (key, serialized fst) of a FST archive
+    """
+    far = pynini.Far(x, "r")
+    while not far.done():
+        yield far.get_key(), far.get_fst().write_to_string()
+        far.next()
+    far.close()
+
+
+def correct_corpus(config, input_path, output_path, workers=None, input_type="auto", chunksize=16, \
+                    pipeline_opts=None, progress=None, progress_every=10000):
+    """
+        correct a whole corpus with a pool of worker processes, results are written in input order
+        as "utt_id corrected string" lines.
+        Graphs are loaded once in this process, forked workers share them copy-on-write.
+        Args:
+            config: dict like pipeline.default_config()
+            input_path: Kaldi text file or FST archive
+            workers: number of processes, os.cpu_count() if None
+            input_type: text, far or auto (far if input_path ends with .far)
+            progress: callable(stats) called every progress_every utterances
+        Return:
+            stats: dict {"utterances", "errors", "seconds", "utt_per_sec", "utt_per_sec_per_core"}
+    """
+    workers = workers or os.cpu_count()
+    pipeline_opts = pipeline_opts or {}
+    if input_type == "auto":
+        input_type = "far" if input_path.endswith(".far") else "text"
+    items = read_far(input_path) if input_type == "far" else read_kaldi_text(input_path)
+
+    _worker["pipeline"] = load_pipeline(config, **pipeline_opts)
+    _worker["pipeline"].preload()
+    _start = time.time()
+    stats = {"utterances": 0, "errors": 0}
+
+    def update_stats():
+        stats["seconds"] = time.time() - _start
+        stats["utt_per_sec"] = stats["utterances"] / max(stats["seconds"], 1e-9)
+        stats["utt_per_sec_per_core"] = stats["utt_per_sec"] / workers
+
+        return stats
+
+    if workers == 1:
+        pool = None
+        results = map(worker_process, items)
+    else:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        pool = context.Pool(workers, initializer=worker_init, initargs=(config, pipeline_opts))
+        results = pool.imap(worker_process, items, chunksize=chunksize)
+
+    try:
+        with io.open(output_path, "w", encoding="utf-8") as f:
+            for utt_id, text, error in results:
+                f.write("{} {}\n".format(utt_id, text))
+                stats["utterances"] += 1
+                if error is not None:
+                    stats["errors"] += 1
+                if progress is not None and stats["utterances"] % progress_every == 0:
+                    progress(update_stats())
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return update_stats()
@@ -0,0 +1,128 @@
+# Copyright 2020 (author: Meng Wu)
+
+import io
+import os
+import shutil
+import hashlib
+import pynini
+import pywrapfst
+from .common import to_const
+from .utils import DataIO, file_hash
+
+
+class GraphCache():
+    """
+        On-disk store for compiled graphs and symbol tables.
+        Every stage is keyed by a content hash of the files it was built from (plus its build options),
+        so a stage is only recompiled when one of its own inputs changed.
+        Layout:
+            <cache_dir>/<stage>.<key>/MANIFEST
+            <cache_dir>/<stage>.<key>/<name>.fst
+            <cache_dir>/<stage>.<key>/<name>.txt
+        With fst_type="const" graphs are stored and loaded as read-only ConstFst (see common.to_const),
+        which reads much faster and is one compact block shared by forked worker processes.
+    """
+    def __init__(self, cache_dir, encode="utf-8", fst_type="vector"):
+        if fst_type not in ["vector", "const"]:
+            raise ValueError("fst_type is only vector or const")
+
+        self.cache_dir = cache_dir
+        self.fst_type = fst_type
+        self.data_io = DataIO(encode=encode)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def file_hash(self, x):
+        return file_hash(x)
+
+    def make_key(self, deps, **opts):
+        """
+            Input:
+                deps: list of file paths the stage depends on
+                opts: build options which change the stage output
+            Return:
+                key (string)
+        """
+        h = hashlib.sha1()
+        for path in deps:
+            if path is not None:
+                h.update(self.file_hash(path).encode())
+        for k in sorted(opts.keys()):
+            h.update("{}={};".format(k, opts[k]).encode())
+
+        return h.hexdigest()[:16]
+
+    def stage_dir(self, name, key):
+        return os.path.join(self.cache_dir, "{}.{}".format(name, key))
+
+    def load_stage(self, name, key):
+        """
+            Return:
+                dict of {artifact name: pynini.Fst or SymbolTable}, None if not cached
+        """
+        stage_dir = self.stage_dir(name, key)
+        manifest = os.path.join(stage_dir, "MANIFEST")
+        if not os.path.isfile(manifest):
+            return None
+
+        artifacts = {}
+        for artifact, kind in self.data_io.read_file_to_list(manifest):
+            if kind == "fst" and self.fst_type == "const":
+                artifacts[artifact] = pywrapfst.Fst.read(os.path.join(stage_dir, artifact + ".fst"))
+            elif kind == "fst":
+                artifacts[artifact] = pynini.Fst.read(os.path.join(stage_dir, artifact + ".fst"))
+            else:
+                artifacts[artifact] = self.data_io.read_symbol_table(os.path.join(stage_dir, artifact + ".txt"))
+
+        return artifacts
+
+    def save_stage(self, name, key, artifacts):
+        """
+            write into a temporary directory and rename it, so concurrent workers never see a partial stage
+        """
+        stage_dir = self.stage_dir(name, key)
+        tmp_dir = "{}.tmp{}".format(stage_dir, os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        manifest = []
+        for artifact, value in artifacts.items():
+            if isinstance(value, pywrapfst.Fst):
+                value.write(os.path.join(tmp_dir, artifact + ".fst"))
+                manifest.append("{} fst".format(artifact))
+            else:
+                self.data_io.write_word_tb(value, os.path.join(tmp_dir, artifact + ".txt"))
+                manifest.append("{} table".format(artifact))
+
+        with io.open(os.path.join(tmp_dir, "MANIFEST"), "w", encoding="utf-8") as f:
+            f.write("\n".join(manifest) + "\n")
+
+        try:
+            os.rename(tmp_dir, stage_dir)
+        except OSError:
+            # another process has finished the same stage first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def stage(self, name, deps, builder, **opts):
+        """
+            load stage artifacts from cache, or build them by builder() and store
+            Args:
+                name: stage name
+                deps: list of file paths
+                builder: callable returning dict of {artifact name: pynini.Fst or SymbolTable}
+            Return:
+                dict of artifacts, fsts are ConstFst if fst_type is const
+        """
+        if self.fst_type != "vector":
+            opts["fst_type"] = self.fst_type
+        key = self.make_key(deps, **opts)
+        artifacts = self.load_stage(name, key)
+        if artifacts is None:
+            artifacts = builder()
+            if self.fst_type == "const":
+                artifacts = { k: to_const(v) if isinstance(v, pywrapfst.Fst) else v for k, v in artifacts.items() }
+            self.save_stage(name, key, artifacts)
+
+        return artifacts
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
@@ -0,0 +1,327 @@
+# Copyright 2020 (author: Meng Wu)
+
+import heapq
+import pynini
+from .common import compose, best_path, expand_sigma, fst_labels, is_empty, has_negative_weights
+
+
+def linear_fst(labels, weight=0.):
+    """
+        linear acceptor of labels with weight on its final state
+    """
+    fst = pynini.Fst()
+    fst.add_states(len(labels) + 1)
+    for i, label in enumerate(labels):
+        fst.add_arc(i, pynini.Arc(label, label, 0, i + 1))
+    fst.set_start(0)
+    fst.set_final(len(labels), weight)
+
+    return fst
+
+
+def token_labels(output):
+    """
+        output labels of a token, oldest first
+    """
+    labels = []
+    while output is not None:
+        labels.append(output[0])
+        output = output[1]
+    labels.reverse()
+
+    return labels
+
+
+class LazyCascade():
+    """
+        On-the-fly composition of x o graphs[0] o graphs[1] o ... searched for its shortest path.
+        The product machine is never built, only the states reached by a best-first search are expanded.
+        Arcs of each graph are indexed by input label the first time a state is visited and kept for
+        later utterances, which plays the role of a cached matcher.
+        Arcs with sigma_label on input side match any label in sigma_ids (TagHelper(sigma="compact")),
+        they are resolved here like a sigma matcher instead of expanding the graph.
+        Note:
+            The best-first search stops at the first final state popped, which is only right for non-negative weights.
+            Hypotheses with negative weights (Kaldi lattice costs can be) and graphs found with negative weights
+            are composed eagerly instead.
+    """
+    def __init__(self, *graphs, sigma_label=None, sigma_ids=None, max_cached_states=1 << 16):
+        """
+            Args:
+                max_cached_states: matcher cache of each graph is cleared once it holds more states,
+                                   so a long-running server does not keep the whole graph indexed
+        """
+        self.graphs = list(graphs)
+        self.index = [ {} for _ in graphs ]
+        self.finals = [ {} for _ in graphs ]
+        self.sigma_label = sigma_label
+        self.sigma_ids = sigma_ids
+        self.max_cached_states = max_cached_states
+        self.negative_weights = False
+
+    def matcher(self, k, state):
+        """
+            Return:
+                dict {ilabel: [(olabel, weight, nextstate)]} of state in graphs[k]
+        """
+        index = self.index[k]
+        if state not in index:
+            if len(index) >= self.max_cached_states:
+                index.clear()
+            arcs = {}
+            for arc in self.graphs[k].arcs(state):
+                weight = float(arc.weight)
+                if weight < 0:
+                    self.negative_weights = True
+                arcs.setdefault(arc.ilabel, []).append((arc.olabel, weight, arc.nextstate))
+            index[state] = arcs
+
+        return index[state]
+
+    def match(self, k, state, label):
+        """
+            Return:
+                list of (olabel, weight, nextstate) of arcs in graphs[k] which accept label
+        """
+        arcs = self.matcher(k, state)
+        if self.sigma_label is None or label not in self.sigma_ids or self.sigma_label not in arcs:
+            return arcs.get(label, [])
+
+        sigma_arcs = [ (label if olabel == self.sigma_label else olabel, weight, nextstate) \
+                        for olabel, weight, nextstate in arcs[self.sigma_label] ]
+
+        return arcs.get(label, []) + sigma_arcs
+
+    def final(self, k, state):
+        finals = self.finals[k]
+        if state not in finals:
+            if len(finals) >= self.max_cached_states:
+                finals.clear()
+            finals[state] = float(self.graphs[k].final(state))
+            if finals[state] < 0:
+                self.negative_weights = True
+
+        return finals[state]
+
+    def propagate(self, k, label, states):
+        """
+            feed label into graphs[k:], yield (new states tail, weight, output label)
+            states[0] is the hypothesis state, states[k + 1] is the state of graphs[k]
+        """
+        if k == len(self.graphs):
+            yield (), 0., label
+            return
+
+        for olabel, weight, nextstate in self.match(k, states[k + 1], label):
+            if olabel == 0:
+                yield (nextstate,) + tuple(states[k + 2:]), weight, 0
+            else:
+                for tail, _weight, _olabel in self.propagate(k + 1, olabel, states):
+                    yield (nextstate,) + tail, weight + _weight, _olabel
+
+    def expand(self, x, states):
+        """
+            all moves of the product state, yield (new states, weight, output label)
+        """
+        # the hypothesis moves and its output is consumed downstream
+        for arc in x.arcs(states[0]):
+            weight = float(arc.weight)
+            if arc.olabel == 0:
+                yield (arc.nextstate,) + tuple(states[1:]), weight, 0
+            else:
+                for tail, _weight, olabel in self.propagate(0, arc.olabel, states):
+                    yield (arc.nextstate,) + tail, weight + _weight, olabel
+
+        for move in self.epsilon_moves(states):
+            yield move
+
+    def epsilon_moves(self, states):
+        """
+            graphs[k] moves alone by an input epsilon arc, yield (new states, weight, output label)
+        """
+        for k in range(len(self.graphs)):
+            for olabel, weight, nextstate in self.matcher(k, states[k + 1]).get(0, []):
+                head = tuple(states[:k + 1]) + (nextstate,)
+                if olabel == 0:
+                    yield head + tuple(states[k + 2:]), weight, 0
+                else:
+                    for tail, _weight, _olabel in self.propagate(k + 1, olabel, states):
+                        yield head + tail, weight + _weight, _olabel
+
+    def start_tokens(self):
+        """
+            token passing over the cascade without a hypothesis fst, for labels fed one position at a time
+            Return:
+                tokens: dict {graph states: (cost, output)}, output is a linked list (label, previous output) or None
+        """
+        start = tuple(graph.start() for graph in self.graphs)
+        if pynini.NO_STATE_ID in start:
+            return {}
+
+        return self.closure({start: (0., None)})
+
+    def closure(self, tokens):
+        """
+            add the tokens reached by input epsilon arcs, tokens is updated in place
+        """
+        queue = list(tokens.keys())
+        while queue:
+            key = queue.pop()
+            cost, output = tokens[key]
+            for nextstates, weight, olabel in self.epsilon_moves((None,) + key):
+                nextkey = nextstates[1:]
+                _cost = cost + weight
+                if _cost < tokens.get(nextkey, (float("inf"),))[0]:
+                    tokens[nextkey] = (_cost, (olabel, output) if olabel != 0 else output)
+                    queue.append(nextkey)
+
+        return tokens
+
+    def step(self, tokens, labels, beam=None, max_tokens=None):
+        """
+            feed one hypothesis position into all tokens
+            Input:
+                labels: list of (label, weight), alternatives of this position
+                beam: drop tokens worse than the best one by more than beam
+                max_tokens: keep at most max_tokens best tokens
+            Return:
+                new tokens, empty if no token accepts any of labels
+        """
+        new_tokens = {}
+        for key, (cost, output) in tokens.items():
+            states = (None,) + key
+            for label, weight in labels:
+                for tail, _weight, olabel in self.propagate(0, label, states):
+                    _cost = cost + weight + _weight
+                    if _cost < new_tokens.get(tail, (float("inf"),))[0]:
+                        new_tokens[tail] = (_cost, (olabel, output) if olabel != 0 else output)
+        new_tokens = self.closure(new_tokens)
+
+        if new_tokens and (beam is not None or (max_tokens is not None and len(new_tokens) > max_tokens)):
+            ranked = sorted(new_tokens.items(), key=lambda item: item[1][0])
+            if beam is not None:
+                ranked = [ item for item in ranked if item[1][0] <= ranked[0][1][0] + beam ]
+            new_tokens = dict(ranked[:max_tokens])
+
+        return new_tokens
+
+    def best_token(self, tokens, final=True):
+        """
+            Return:
+                (cost, output labels) of the best token, with final weights if final, None if there is none
+        """
+        best = None
+        for key, (cost, output) in tokens.items():
+            if final:
+                cost += sum(self.final(k, state) for k, state in enumerate(key))
+            if cost != float("inf") and (best is None or cost < best[0]):
+                best = (cost, output)
+
+        return None if best is None else (best[0], token_labels(best[1]))
+
+    def token_outputs(self, tokens):
+        return [ token_labels(output) for cost, output in tokens.values() ]
+
+    def shortestpath(self, x, nstate=None, fallback="source"):
+        """
+            Input:
+                x: hypothesis fst
+                nstate: (int) max number of expanded product states, search gives up when exceeded
+                fallback: (string) policy when no path is found
+                    source: return the best path of x itself, like compose() returns its source
+                    empty: return an empty fst
+            Return:
+                linear acceptor of the output labels, path weight on its final state
+        """
+        if fallback not in ["source", "empty"]:
+            raise ValueError("fallback is only source or empty")
+        if self.negative_weights or has_negative_weights(x):
+            return self.eager_shortestpath(x, fallback)
+
+        result = self.search(x, nstate)
+        if self.negative_weights:
+            # some graph arc reached by this search is negative, its result may not be the best path
+            return self.eager_shortestpath(x, fallback)
+
+        return self._fallback(x, fallback) if result is None else result
+
+    def search(self, x, nstate=None):
+        """
+            best-first search of the product machine
+            Return:
+                linear acceptor of the best path, None if there is no path or nstate is exceeded
+        """
+        start = (x.start(),) + tuple(graph.start() for graph in self.graphs)
+        if pynini.NO_STATE_ID in start:
+            return None
+
+        # heap items are (cost, order, is_final, states)
+        heap = [ (0., 0, False, start) ]
+        best = {start: 0.}
+        back = {start: None}
+        expanded = set()
+        order = 1
+        bound = float("inf")
+
+        while heap:
+            cost, _, is_final, states = heapq.heappop(heap)
+            if is_final:
+                return self._build(states, cost, back)
+            if states in expanded or cost > best.get(states, float("inf")):
+                continue
+            expanded.add(states)
+            if nstate is not None and len(expanded) > nstate:
+                break
+
+            final_weight = float(x.final(states[0])) + sum(self.final(k, s) for k, s in enumerate(states[1:]))
+            if final_weight != float("inf") and cost + final_weight < bound:
+                bound = cost + final_weight
+                heapq.heappush(heap, (bound, order, True, states))
+                order += 1
+
+            for nextstates, weight, olabel in self.expand(x, states):
+                _cost = cost + weight
+                # branch and bound by the best complete path found so far
+                if _cost < best.get(nextstates, float("inf")) and _cost <= bound:
+                    best[nextstates] = _cost
+                    back[nextstates] = (states, olabel)
+                    heapq.heappush(heap, (_cost, order, False, nextstates))
+                    order += 1
+
+        return None
+
+    def eager_shortestpath(self, x, fallback="source"):
+        """
+            compose x with all graphs like get_result(), compact sigma-star arcs are expanded over the labels
+            coming from the left side of each composition
+        """
+        result = x
+        for graph in self.graphs:
+            if self.sigma_label is not None:
+                graph = expand_sigma(graph, self.sigma_label, [ i for i in fst_labels(result, "output") \
+                                                                if i != 0 and i in self.sigma_ids ])
+            result = compose(result, graph, fallback="empty")
+            if is_empty(result):
+                return self._fallback(x, fallback)
+
+        labels, weight = best_path(result)
+
+        return linear_fst(labels, weight)
+
+    def _build(self, states, cost, back):
+        labels = []
+        while back[states] is not None:
+            states, olabel = back[states]
+            if olabel != 0:
+                labels.append(olabel)
+        labels.reverse()
+
+        return linear_fst(labels, cost)
+
+    def _fallback(self, x, fallback):
+        if fallback == "empty":
+            return pynini.Fst()
+
+        labels, weight = best_path(x)
+
+        return linear_fst(labels, weight)
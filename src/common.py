@@ -1,51 +1,57 @@
 # Copyright 2020 (author: Meng Wu)
 
 import pynini
+import pywrapfst
+from array import array
+from .utils import SymbolTable
+from . import metrics
 
-def list2fst(x, in_syms, out_syms):
+def arrays2fst(src, dst, ilabel, olabel, weight=None, num_states=None, start=0, finals=(0,)):
     """
+        compile numeric arc buffers into fst.
+        States are allocated at once, arcs are still added one add_arc() call each (pynini has no bulk arc API),
+        the saving against string arc lists is skipping the formatting and parsing of every field.
         Input:
-            x is like:
-                [['0', '1', '世界', '世博會', '0.1053605157'], ['1', '0', '博覽會', '<eps>'],
-                ['0', '2', '一個', '一個巨星的誕生', '0.1053605157'], ['2', '3', '巨星', '<eps>'],
-                ['3', '4', '的', '<eps>'], ['4', '0', '誕生', '<eps>']]
-            in_syms, out_syms is symbols table (dict)
+            src, dst, ilabel, olabel: int sequences of the same length (array.array, list or numpy array)
+            weight: float sequence of tropical arc weights, None if all arcs are One
+            num_states: number of states, max state id + 1 if not given
+            start: start state
+            finals: list of final states, or dict {state: final weight}
         Return:
-            Fst
+            Fst with exactly num_states states, not optimized
     """
-    if x is not None:
-        fst = pynini.Fst()
-        fst.add_state()
-        fst.set_start(0)
-        for i in x:
-            if len(i) == 5:
-                state_in, state_out, arc_in, arc_out, arc_weight = i
-                state_in = int(state_in)
-                state_out = int(state_out)
-                arc_in = int(in_syms[arc_in])
-                arc_out = int(out_syms[arc_out])
-                arc_weight = pynini.Weight("tropical", float(arc_weight))
-                fst.add_state()
-                fst.add_arc(state_in, pynini.Arc(arc_in, arc_out, arc_weight, state_out))
-            
-            elif len(i) == 4:
-                state_in, state_out, arc_in, arc_out = i
-                state_in = int(state_in)
-                state_out = int(state_out)
-                arc_in = int(in_syms[arc_in])
-                arc_out = int(out_syms[arc_out])
-                arc_weight = pynini.Weight("tropical", 0)
-                fst.add_state()
-                fst.add_arc(state_in, pynini.Arc(arc_in, arc_out, arc_weight, state_out))
-            
-            else:
-                fst.set_final(0)
-        
-        return fst.optimize()
-    
+    src, dst, ilabel, olabel = [ x.tolist() if hasattr(x, "tolist") else x for x in [src, dst, ilabel, olabel] ]
+    if weight is not None and hasattr(weight, "tolist"):
+        weight = weight.tolist()
+    if num_states is None:
+        num_states = max(max(src, default=-1), max(dst, default=-1), start) + 1
+
+    fst = pynini.Fst()
+    fst.add_states(num_states)
+    fst.set_start(start)
+    if isinstance(finals, dict):
+        for state, final_weight in finals.items():
+            fst.set_final(state, final_weight)
+    else:
+        for state in finals:
+            fst.set_final(state)
+
+    add_arc = fst.add_arc
+    Arc = pynini.Arc
+    _one = pynini.Weight.one("tropical")
+    if weight is None:
+        for i in range(len(src)):
+            add_arc(src[i], Arc(ilabel[i], olabel[i], _one, dst[i]))
     else:
+        # arc weights are few distinct values in practice, one Weight object for each of them
+        _weights = {}
+        for i in range(len(src)):
+            _weight = _weights.get(weight[i])
+            if _weight is None:
+                _weight = _weights[weight[i]] = pynini.Weight("tropical", weight[i])
+            add_arc(src[i], Arc(ilabel[i], olabel[i], _weight, dst[i]))
 
-        raise(ValueError, "empty fst list")
+    return fst
 
 
 def load_fst(x):
@@ -68,7 +74,95 @@ def read_string_as_fst(x):
     return fst
 
 
-def compose(fst1, fst2, direction="right", project=None):
+def is_empty(fst):
+    """
+        constant-time emptiness check, pynini.compose connects its result so an empty composition has no state
+    """
+    return fst.num_states() == 0 or fst.start() == pynini.NO_STATE_ID
+
+
+def has_negative_weights(x):
+    """
+        any arc or final weight below zero, e.g. Kaldi lattice costs
+    """
+    for state in x.states():
+        if float(x.final(state)) < 0:
+            return True
+        for arc in x.arcs(state):
+            if float(arc.weight) < 0:
+                return True
+
+    return False
+
+
+# composition counters, unsorted: an operand was not sorted on its matching side and was sorted on a copy
+compose_stats = {"calls": 0, "unsorted": 0}
+
+
+def is_arcsorted(x, sort_type="ilabel"):
+    prop = pynini.I_LABEL_SORTED if sort_type == "ilabel" else pynini.O_LABEL_SORTED
+
+    return x.properties(prop, True) == prop
+
+
+def arcsort_static(x, sort_type="ilabel"):
+    """
+        sort a static graph once on the side it is matched in composition,
+        olabel if it is a left operand, ilabel if it is a right operand.
+        The sorted property is kept in fst properties and in written files, so compose never sorts it again.
+        Return:
+            x sorted in place, or a sorted copy if x is const
+    """
+    if is_arcsorted(x, sort_type):
+        return x
+    if is_const(x):
+        return to_const(x, sort_type)
+
+    return x.arcsort(sort_type)
+
+
+def to_const(x, sort_type=None):
+    """
+        read-only ConstFst copy of x for static graphs, arcs are sorted when converted
+        so it could be composed later without any copy of it.
+        Args:
+            sort_type: ilabel or olabel, None keeps the sorted side of x (ilabel if x is not sorted)
+        Return:
+            pywrapfst.Fst of const type
+    """
+    if sort_type is None:
+        sort_type = "olabel" if is_arcsorted(x, "olabel") and not is_arcsorted(x, "ilabel") else "ilabel"
+
+    fst = x.copy() if isinstance(x, pynini.Fst) else pynini.Fst.from_pywrapfst(x)
+    fst.arcsort(sort_type)
+
+    return pywrapfst.convert(fst, "const")
+
+
+def is_const(x):
+    return not isinstance(x, pywrapfst.MutableFst)
+
+
+def _compose(fst1, fst2):
+    compose_stats["calls"] += 1
+    if not is_arcsorted(fst1, "olabel") or not is_arcsorted(fst2, "ilabel"):
+        compose_stats["unsorted"] += 1
+
+    if isinstance(fst1, pynini.Fst) and isinstance(fst2, pynini.Fst):
+        # pynini.compose only copies and sorts an operand without the sorted property
+        return pynini.compose(fst1, fst2)
+
+    # const fst (see to_const) is never changed, only the mutable side gets a sorted copy
+    if isinstance(fst1, pynini.Fst):
+        fst1 = fst1.copy().arcsort("olabel")
+    if isinstance(fst2, pynini.Fst):
+        fst2 = fst2.copy().arcsort("ilabel")
+
+    return pynini.Fst.from_pywrapfst(pywrapfst.compose(fst1, fst2))
+
+
+@metrics.timed("compose", fst_in=0)
+def compose(fst1, fst2, direction="right", project=None, fallback="source"):
     """
         overwrite FST compose function, if compose is nothing return source fst to avoid get empty result
         Args:
@@ -78,65 +172,264 @@ def compose(fst1, fst2, direction="right", project=None):
             project: (string)
                 input: fst project input
                 output: fst project output
+            fallback: (string) policy when the composition is empty
+                source: return the source fst (fst1 if direction is right, else fst2)
+                empty: return the empty composition
+                raise: raise ValueError
     """
+    if fallback not in ["source", "empty", "raise"]:
+        raise ValueError("fallback is only source, empty or raise")
+
     if direction == "right":
-        fst = pynini.compose(fst1, fst2)
+        fst = _compose(fst1, fst2)
     elif direction == "left":
-        fst = pynini.compose(fst2, fst1)
+        fst = _compose(fst2, fst1)
     else:
         raise ValueError("direction is only right or left")
 
-    if fst.print() != "":
+    if not is_empty(fst):
         if project is not None:
             fst.project(project)
-            return fst.optimize()
-        else:
+        with metrics.span("optimize", fst, fst):
             return fst.optimize()
     else:
-        if direction == "right":
+        if fallback == "empty":
+            return fst
+        elif fallback == "raise":
+            raise ValueError("composition is empty")
+        elif direction == "right":
             return fst1
         else:
             return fst2
 
 
+def fst_size(x):
+    """
+        Return:
+            (number of states, number of arcs)
+    """
+    num_states = 0
+    num_arcs = 0
+    # const fst has no num_states()
+    for state in x.states():
+        num_states += 1
+        num_arcs += x.num_arcs(state)
+
+    return num_states, num_arcs
+
+
+def prune_lattice(x, beam=None, max_states=None, determinize=False, minimize=False, det_max_states=None):
+    """
+        bound the size of a hypothesis lattice before it is composed with other graphs
+        Args:
+            beam: (float) remove paths whose weight is worse than best path weight + beam
+            max_states: (int) keep at most max_states states, worst states are pruned first
+            determinize: (bool) determinize the lattice, transducers are determinized with encoded labels
+            minimize: (bool) minimize after determinize
+            det_max_states: (int) state budget of determinization, stop expanding when exceeded
+        Return:
+            fst: pruned lattice
+            stats: dict of states/arcs before and after pruning and how many were removed
+    """
+    states_in, arcs_in = fst_size(x)
+
+    if beam is not None or max_states is not None:
+        x = pynini.prune(x, weight=beam, nstate=max_states if max_states is not None else pynini.NO_STATE_ID)
+
+    if determinize:
+        if det_max_states is None:
+            det_max_states = pynini.NO_STATE_ID
+
+        if x.properties(pynini.ACCEPTOR, True) == pynini.ACCEPTOR:
+            x = pynini.determinize(x, nstate=det_max_states, weight=beam)
+            if minimize:
+                x.minimize()
+        else:
+            mapper = pynini.EncodeMapper(x.arc_type(), encode_labels=True)
+            x = pynini.determinize(x.copy().encode(mapper), nstate=det_max_states, weight=beam)
+            if minimize:
+                x.minimize()
+            x.decode(mapper)
+
+    states_out, arcs_out = fst_size(x)
+    stats = {"states_in": states_in, "arcs_in": arcs_in, "states_out": states_out, "arcs_out": arcs_out, \
+                "states_removed": states_in - states_out, "arcs_removed": arcs_in - arcs_out}
+
+    return x, stats
+
+
+def fst_labels(x, side="output"):
+    """
+        Return:
+            set of labels on input or output side of x
+    """
+    labels = set()
+    for state in x.states():
+        for arc in x.arcs(state):
+            labels.add(arc.ilabel if side == "input" else arc.olabel)
+
+    return labels
+
+
+def expand_sigma(x, sigma_label, alphabet):
+    """
+        replace each arc with sigma_label on its input side by one arc per label in alphabet,
+        the output label follows the input label if it is sigma_label as well
+        Return:
+            new fst, x is not modified
+    """
+    fst = x.copy() if isinstance(x, pynini.Fst) else pynini.Fst.from_pywrapfst(x)
+    for state in fst.states():
+        arcs = list(fst.arcs(state))
+        if not any(arc.ilabel == sigma_label for arc in arcs):
+            continue
+
+        fst.delete_arcs(state)
+        for arc in arcs:
+            if arc.ilabel != sigma_label:
+                fst.add_arc(state, arc)
+            else:
+                for label in alphabet:
+                    _olabel = label if arc.olabel == sigma_label else arc.olabel
+                    fst.add_arc(state, pynini.Arc(label, _olabel, arc.weight, arc.nextstate))
+
+    return fst
+
+
 def union(*args):
     fst = pynini.Fst()
     for arg in args:
-        fst.union(arg)
+        fst.union(arg if isinstance(arg, pynini.Fst) else pynini.Fst.from_pywrapfst(arg))
     
     return fst
 
 
-def get_result(x, *args):
+@metrics.timed("get_result", fst_in=0)
+def get_result(x, *args, nshortest=1, beam=None):
+    """
+        compose x with args in order and keep the output side
+        Args:
+            nshortest: (int) number of best paths kept, each one is a branch from the start state
+            beam: (float) if given, return the lattice pruned to paths within beam of the best path
+                  instead of the shortest path(s)
+    """
     for arg in args:
         #x = pynini.compose(x, arg)
         x = compose(x, arg)
 
     x.project("output")
-    x.optimize()
-    x = pynini.shortestpath(x)
+    with metrics.span("optimize", x, x):
+        x.optimize()
+    if beam is not None:
+        with metrics.span("prune", x) as span:
+            x = pynini.prune(x, weight=beam)
+            span.fst_out = x
+        return x
+
+    with metrics.span("shortestpath", x) as span:
+        if nshortest > 1:
+            x = pynini.shortestpath(x, nshortest=nshortest, unique=True)
+        else:
+            x = pynini.shortestpath(x)
+        span.fst_out = x
 
     return pynini.topsort(x)
 
 
+def best_path(x, side="output", syms=None):
+    """
+        walk the shortest path of a fst state by state
+        Input:
+            side: (string) take input or output labels
+            syms: SymbolTable, or reversed symbols table (dict) {idx(string): symbol}
+        Return:
+            labels: array of int without epsilon, or list of symbols if syms is given
+            weight: float, path weight
+    """
+    path = pynini.shortestpath(x)
+    labels = array("l")
+    weight = 0.
+    state = path.start()
+    if state == pynini.NO_STATE_ID:
+        return labels, float("inf")
+
+    # shortestpath result is a single path, each state has at most one arc
+    while True:
+        arc = None
+        for arc in path.arcs(state):
+            break
+        if arc is None:
+            break
+
+        label = arc.ilabel if side == "input" else arc.olabel
+        if label != 0:
+            labels.append(label)
+        weight += float(arc.weight)
+        state = arc.nextstate
+
+    weight += float(path.final(state))
+
+    if isinstance(syms, SymbolTable):
+        return [ syms.get_symbol(label) for label in labels ], weight
+    elif syms is not None:
+        return [ syms[str(label)] for label in labels ], weight
+    else:
+        return labels, weight
+
+
+def nbest_paths(x, nshortest=None, side="output", syms=None):
+    """
+        enumerate the paths of an acyclic fst, like the result of get_result(nshortest=n)
+        a lattice has exponentially many paths (a pruned one could still be cyclic), read it with nshortest
+        Input:
+            nshortest: (int) if given, take the n shortest unique paths of x first
+            side: (string) take input or output labels
+            syms: SymbolTable, or reversed symbols table (dict) {idx(string): symbol}
+        Return:
+            list of (labels, weight) sorted by weight, labels like best_path()
+    """
+    if nshortest is not None:
+        x = pynini.shortestpath(x, nshortest=nshortest, unique=True)
+    elif x.properties(pynini.ACYCLIC, True) != pynini.ACYCLIC:
+        raise ValueError("x is cyclic, its paths can only be read with nshortest")
+
+    paths = []
+    start = x.start()
+    if start == pynini.NO_STATE_ID:
+        return paths
+
+    # depth-first search, stack items are (state, labels, weight)
+    stack = [ (start, array("l"), 0.) ]
+    while stack:
+        state, labels, weight = stack.pop()
+        final_weight = float(x.final(state))
+        if final_weight != float("inf"):
+            paths.append((labels, weight + final_weight))
+
+        for arc in x.arcs(state):
+            label = arc.ilabel if side == "input" else arc.olabel
+            _labels = array("l", labels)
+            if label != 0:
+                _labels.append(label)
+            stack.append((arc.nextstate, _labels, weight + float(arc.weight)))
+
+    paths.sort(key=lambda path: path[1])
+    if isinstance(syms, SymbolTable):
+        paths = [ ([ syms.get_symbol(label) for label in labels ], weight) for labels, weight in paths ]
+    elif syms is not None:
+        paths = [ ([ syms[str(label)] for label in labels ], weight) for labels, weight in paths ]
+
+    return paths
+
+
 def fst_to_linear_sequence(x, syms=None):
     """
-        convert a fst into a linear sequence
-    """
-    best_path = pynini.topsort(pynini.shortestpath(x))
-    seq = []
-    for line in best_path.print().split("\n"):
-        try:
-            if syms is not None:
-                try:
-                    temp = syms[line.strip().split()[3]]
-                except:
-                    pass
-            else:
-                temp = line.strip().split()[3]
-            seq.append(temp)
-        except:
-            continue
-    
+        convert a fst into a linear sequence, epsilons are skipped
+        Input:
+            syms: SymbolTable, or reversed symbols table (dict) {idx(string): symbol}
+        Return:
+            string of labels (or symbols if syms is given) split by space
+    """
+    seq, _ = best_path(x, syms=syms)
 
-    return " ".join(seq)
+    return " ".join(str(i) for i in seq)
@@ -0,0 +1,248 @@
+# Copyright 2020 (author: Meng Wu)
+"""
+    Opt-in instrumentation of pipeline stages.
+    Instrumented functions (compose, get_result, generate_replace_fst, graph builders, ...) only check
+    a flag while metrics are disabled. Once enable() is called every stage records its wall time,
+    states/arcs of its input and output fst and the tokenizer segmentations it caused, aggregated
+    per stage into histograms. Read them with snapshot(), prometheus_text() / write_prometheus(),
+    or get every single record through the callback given to enable().
+"""
+
+import os
+import time
+import tempfile
+import functools
+
+# seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+# arcs of output fst
+SIZE_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+_state = {"enabled": False, "callback": None, "count_arcs": True}
+# global event counters, e.g. tokenizer_calls, a stage records how much they grew while it ran
+counters = {"tokenizer_calls": 0}
+# {stage: aggregated stats}, see record()
+stages = {}
+
+
+def enable(callback=None, count_arcs=True):
+    """
+        Args:
+            callback: callable(record dict) called after every stage, see record()
+            count_arcs: count arcs of input and output fsts, it walks all of their states
+    """
+    _state.update({"enabled": True, "callback": callback, "count_arcs": count_arcs})
+
+
+def disable():
+    _state.update({"enabled": False, "callback": None})
+
+
+def is_enabled():
+    return _state["enabled"]
+
+
+def reset():
+    stages.clear()
+    for key in counters:
+        counters[key] = 0
+
+
+def count(name, n=1):
+    if _state["enabled"]:
+        counters[name] = counters.get(name, 0) + n
+
+
+def fst_size(x):
+    """
+        Return:
+            (states, arcs), arcs is None if count_arcs is disabled
+    """
+    if not _state["count_arcs"]:
+        return (x.num_states() if hasattr(x, "num_states") else None), None
+
+    num_states = 0
+    num_arcs = 0
+    for state in x.states():
+        num_states += 1
+        num_arcs += x.num_arcs(state)
+
+    return num_states, num_arcs
+
+
+def new_stage():
+    return {"count": 0, "seconds": 0., "seconds_buckets": [ 0 ] * len(LATENCY_BUCKETS), "max_seconds": 0., \
+            "states_in": 0, "arcs_in": 0, "states_out": 0, "arcs_out": 0, "arcs_out_buckets": [ 0 ] * len(SIZE_BUCKETS), \
+            "max_arcs_out": 0, "tokenizer_calls": 0}
+
+
+def observe(buckets, bounds, value):
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            buckets[i] += 1
+            break
+
+
+def record(stage, seconds, size_in=None, fst_out=None, tokenizer_calls=0):
+    """
+        add one run of stage
+        Args:
+            size_in: (states, arcs) of the input fst, measured before the stage ran
+            fst_out: output fst, measured if it is a fst
+    """
+    rec = {"stage": stage, "seconds": seconds, "tokenizer_calls": tokenizer_calls}
+    if size_in is not None:
+        rec["states_in"], rec["arcs_in"] = size_in
+    if hasattr(fst_out, "states"):
+        rec["states_out"], rec["arcs_out"] = fst_size(fst_out)
+
+    stats = stages.get(stage)
+    if stats is None:
+        stats = stages[stage] = new_stage()
+    stats["count"] += 1
+    stats["seconds"] += seconds
+    stats["max_seconds"] = max(stats["max_seconds"], seconds)
+    observe(stats["seconds_buckets"], LATENCY_BUCKETS, seconds)
+    stats["tokenizer_calls"] += tokenizer_calls
+    for key in ["states_in", "arcs_in", "states_out"]:
+        stats[key] += rec.get(key) or 0
+    if rec.get("arcs_out") is not None:
+        stats["arcs_out"] += rec["arcs_out"]
+        stats["max_arcs_out"] = max(stats["max_arcs_out"], rec["arcs_out"])
+        observe(stats["arcs_out_buckets"], SIZE_BUCKETS, rec["arcs_out"])
+
+    if _state["callback"] is not None:
+        _state["callback"](rec)
+
+
+class Span():
+    """
+        context manager recording the block as one run of stage, set fst_out inside the block
+        if the output is a new fst, in-place operations give the same fst as fst_in and fst_out
+    """
+    __slots__ = ("stage", "size_in", "fst_out", "start", "calls")
+
+    def __init__(self, stage, fst_in=None, fst_out=None):
+        self.stage = stage
+        self.size_in = fst_size(fst_in) if hasattr(fst_in, "states") else None
+        self.fst_out = fst_out
+
+    def __enter__(self):
+        self.calls = counters["tokenizer_calls"]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            record(self.stage, time.perf_counter() - self.start, size_in=self.size_in, fst_out=self.fst_out, \
+                    tokenizer_calls=counters["tokenizer_calls"] - self.calls)
+
+
+class NullSpan():
+    """
+        shared span while metrics are disabled, does nothing and ignores fst_out
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def __setattr__(self, key, value):
+        pass
+
+
+_null_span = NullSpan()
+
+
+def span(stage, fst_in=None, fst_out=None):
+    """
+        with span("shortestpath", x) as s:
+            x = pynini.shortestpath(x)
+            s.fst_out = x
+    """
+    if not _state["enabled"]:
+        return _null_span
+
+    return Span(stage, fst_in, fst_out)
+
+
+def timed(stage, fst_in=None):
+    """
+        decorator recording each call as one run of stage, the return value is the output fst
+        Args:
+            fst_in: position of the input fst in the arguments (self is 0 for methods)
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _state["enabled"]:
+                return fn(*args, **kwargs)
+
+            size_in = None
+            if fst_in is not None and fst_in < len(args) and hasattr(args[fst_in], "states"):
+                size_in = fst_size(args[fst_in])
+            calls = counters["tokenizer_calls"]
+            _start = time.perf_counter()
+            result = fn(*args, **kwargs)
+            record(stage, time.perf_counter() - _start, size_in=size_in, fst_out=result, \
+                    tokenizer_calls=counters["tokenizer_calls"] - calls)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def snapshot():
+    """
+        Return:
+            copy of the aggregated stats, {stage: dict}
+    """
+    return { stage: dict(stats, seconds_buckets=list(stats["seconds_buckets"]), \
+                        arcs_out_buckets=list(stats["arcs_out_buckets"])) for stage, stats in stages.items() }
+
+
+def prometheus_text(prefix="brownie"):
+    """
+        Return:
+            aggregated stats in Prometheus text exposition format
+    """
+    lines = []
+
+    def histogram(name, help_text, bounds, buckets_key, sum_key):
+        lines.append("# HELP {}_{} {}".format(prefix, name, help_text))
+        lines.append("# TYPE {}_{} histogram".format(prefix, name))
+        for stage, stats in sorted(stages.items()):
+            cumulative = 0
+            for bound, n in zip(bounds, stats[buckets_key]):
+                cumulative += n
+                lines.append('{}_{}_bucket{{stage="{}",le="{}"}} {}'.format(prefix, name, stage, bound, cumulative))
+            lines.append('{}_{}_bucket{{stage="{}",le="+Inf"}} {}'.format(prefix, name, stage, stats["count"]))
+            lines.append('{}_{}_sum{{stage="{}"}} {}'.format(prefix, name, stage, stats[sum_key]))
+            lines.append('{}_{}_count{{stage="{}"}} {}'.format(prefix, name, stage, stats["count"]))
+
+    histogram("stage_seconds", "Wall time of pipeline stages.", LATENCY_BUCKETS, "seconds_buckets", "seconds")
+    histogram("stage_arcs_out", "Arcs of the fst returned by pipeline stages.", SIZE_BUCKETS, "arcs_out_buckets", "arcs_out")
+
+    for key, help_text in [("states_in", "States of input fsts."), ("arcs_in", "Arcs of input fsts."), \
+                            ("states_out", "States of output fsts."), ("tokenizer_calls", "Tokenizer segmentations.")]:
+        lines.append("# HELP {}_stage_{}_total {}".format(prefix, key, help_text))
+        lines.append("# TYPE {}_stage_{}_total counter".format(prefix, key))
+        for stage, stats in sorted(stages.items()):
+            lines.append('{}_stage_{}_total{{stage="{}"}} {}'.format(prefix, key, stage, stats[key]))
+
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path, prefix="brownie"):
+    """
+        write prometheus_text() into path atomically, e.g. for the textfile collector of node_exporter
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, "w") as f:
+        f.write(prometheus_text(prefix))
+    os.replace(tmp_path, path)
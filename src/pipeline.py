@@ -0,0 +1,363 @@
+# Copyright 2020 (author: Meng Wu)
+
+import os
+from .user_gram import TagHelper, SIGMA_LABEL
+from .user_ne import UserCustomGraph
+from .common import compose, union, get_result, prune_lattice, fst_labels, read_string_as_fst, fst_to_linear_sequence, \
+                        arcsort_static, is_arcsorted, is_empty
+from .cascade import LazyCascade
+from .streaming import StreamingCorrector
+from .cache import GraphCache
+from .tokenizer import set_cache_dir
+from .utils import DataIO, sym2int, int2sym
+from . import metrics
+
+
+# side each static graph is sorted on, by the side it is matched as operand of composition
+GRAPH_SORT = {
+    "Lfst": "olabel", # Lfst o fstC
+    "Lfst_invert": "ilabel", # fstG_subgraph o Lfst_invert
+    "fstG": "ilabel", # hyp o fstG
+    "fstG_subgraph": "olabel",
+    "fstC": "ilabel",
+    "user_graph": "ilabel", # ... o Lfst_invert o user_graph
+}
+
+
+def sort_graphs(graphs):
+    """
+        arcsort static graphs by GRAPH_SORT, graphs already sorted are not touched
+    """
+    for name, sort_type in GRAPH_SORT.items():
+        if name in graphs:
+            graphs[name] = arcsort_static(graphs[name], sort_type)
+
+    return graphs
+
+
+def build_graphs(words, phones, lexicon, grammar, user_table, zh_syllable, jieba_lex=None, \
+                    helper=None, cache=None, work_dir=".", sigma="expand"):
+    """
+        Build all static graphs used by Brownie.
+        Args:
+            words, phones, lexicon, grammar, user_table, zh_syllable, jieba_lex: file paths
+            helper: TagHelper, only be used when some stage need to be compiled
+            cache: GraphCache, if given compiled stages are loaded from / stored into it
+            work_dir: where words_tag.txt and words_user.txt are written
+            sigma: sigma-star mode of TagHelper, must be the same as helper.sigma if helper is given
+        Return:
+            dict with keys:
+                Lfst, Lfst_invert: lexicon fst (phone-in/wd-out) and its invert
+                fstG, fstG_subgraph: tag grammar and sub-graph grammar
+                fstC, fstS, fstI, user_graph: user custom graphs
+                words_tag, words_user: word tables (SymbolTable)
+            fsts are arcsorted by GRAPH_SORT
+    """
+    helpers = {"G": helper}
+    if cache is not None:
+        # the prefix dictionary of jieba is cached next to the graphs, see tokenizer.use_dictionary()
+        set_cache_dir(os.path.join(cache.cache_dir, "jieba"))
+
+    def get_helper():
+        if helpers["G"] is None:
+            helpers["G"] = TagHelper(words, phones, jieba_lex, sigma=sigma)
+
+        return helpers["G"]
+
+    def build_lexicon():
+        creator = get_helper()
+        # one pass over lexicon for both directions
+        lex_fsts = creator.build_lexicon(kaldi_lex=lexicon, add_disambig=False, add_position=False, add_opt_sil="SIL", \
+                                            directions=("lfst", "invert"))
+
+        return {"Lfst": lex_fsts["lfst"], "Lfst_invert": lex_fsts["invert"]}
+
+    def build_grammar():
+        helperG = get_helper()
+        fstG = helperG.read_tag_grammar(grammar)
+        fstG_subgraph = helperG.read_sub_graph_grammar(grammar)
+
+        return {"fstG": fstG, "fstG_subgraph": fstG_subgraph, "words_tag": helperG.word_tb.copy()}
+
+    def build_user():
+        # word table include grammar tags, the passthrough of contextFST is shared through this table
+        DataIO().write_word_tb(graphs["words_tag"], os.path.join(work_dir, "words_tag.txt"))
+        helperU = UserCustomGraph(wd_table_path=graphs["words_tag"], phone_table_path=phones, zh_syllable_table_path=zh_syllable, \
+                                    jieba_lex=jieba_lex, user_table=user_table)
+        fstC = helperU.contextFST() # wd-in/wd-out
+        fstS = helperU.soundslikeFST() # ph-in/wd-out
+        fstI = helperU.ipaFST() # ph-in/wd-out
+        words_user = helperU.word_table(write_words=os.path.join(work_dir, "words_user.txt"))
+        user_graph = union(compose(graphs["Lfst"], fstC), fstS, fstI) # ph-in/wd-out
+
+        return {"fstC": fstC, "fstS": fstS, "fstI": fstI, "user_graph": user_graph, "words_user": words_user}
+
+    def run_stage(name, deps, builder, **opts):
+        # sorted before they are cached, and sort again stages cached before they were sorted
+        with metrics.span("build_graphs." + name):
+            if cache is None:
+                return sort_graphs(builder())
+            else:
+                return sort_graphs(cache.stage(name, deps, lambda: sort_graphs(builder()), **opts))
+
+    graphs = {}
+    graphs.update(run_stage("lexicon", [words, phones, lexicon], build_lexicon, add_opt_sil="SIL"))
+    sigma_opts = {"sigma": sigma}
+    if sigma == "compact":
+        sigma_opts["sigma_label"] = SIGMA_LABEL
+    graphs.update(run_stage("grammar", [words, phones, grammar], build_grammar, **sigma_opts))
+    graphs.update(run_stage("user", [words, phones, lexicon, grammar, user_table, zh_syllable, jieba_lex], build_user, **sigma_opts))
+
+    return graphs
+
+
+def default_config(conf_dir="./conf", cache_dir="./graph_cache"):
+    """
+        file paths of a conf directory laid out like ./conf, used by load_pipeline()
+    """
+    return {
+        "words": os.path.join(conf_dir, "words.txt"),
+        "phones": os.path.join(conf_dir, "phones.txt"),
+        "lexicon": os.path.join(conf_dir, "lexicon.txt"),
+        "grammar": os.path.join(conf_dir, "grammar.txt"),
+        "user_table": os.path.join(conf_dir, "user_table.txt"),
+        "zh_syllable": os.path.join(conf_dir, "zh_syllable.txt"),
+        "jieba_lex": os.path.join(conf_dir, "jieba.lex.txt"),
+        "cache_dir": cache_dir,
+        "fst_type": "vector",
+        "sigma": "expand",
+    }
+
+
+def load_pipeline(config, candidates=False, **kwargs):
+    """
+        build or reload (through GraphCache if config["cache_dir"] is set) the graphs of config
+        Args:
+            config: dict like default_config()
+            candidates: correct with per-request user graphs of the entries retrieved by a phonetic index,
+                        latency does not grow with the user table
+            kwargs: BrowniePipeline options
+        Return:
+            BrowniePipeline
+    """
+    sigma = config.get("sigma", "expand")
+    helper = TagHelper(config["words"], config["phones"], config.get("jieba_lex"), sigma=sigma)
+    cache = None
+    if config.get("cache_dir") is not None:
+        cache = GraphCache(config["cache_dir"], fst_type=config.get("fst_type", "vector"))
+    graphs = build_graphs(config["words"], config["phones"], config["lexicon"], config["grammar"], config["user_table"], \
+                            config["zh_syllable"], jieba_lex=config.get("jieba_lex"), helper=helper, cache=cache, \
+                            work_dir=config.get("work_dir", "."), sigma=sigma)
+    kwargs.setdefault("anchors", helper.grammar_anchors(config["grammar"]))
+    if candidates:
+        kwargs["user_custom"] = UserCustomGraph(config["user_table"], graphs["words_tag"], config["phones"], \
+                                                config["zh_syllable"], jieba_lex=config.get("jieba_lex"))
+
+    return BrowniePipeline.from_graphs(graphs, helper, **kwargs)
+
+
+class BrowniePipeline():
+    """
+        Hold the prebuilt graphs and correct many hypotheses with them.
+        The static right-hand chain fstG_subgraph o Lfst_invert o user_graph is composed and optimized once,
+        then each hypothesis only needs a single composition with it.
+        In lazy mode the chain is not composed at all, see LazyCascade.
+    """
+    def __init__(self, fstG, fstG_subgraph, Lfst_invert, user_graph, helper, syms_tb, \
+                    nonterminal_in="<CONTACT>", nonterminal_out="</CONTACT>", prune_opts=None, \
+                    lazy=False, lazy_max_states=None, ne_graph=None, user_custom=None, Lfst=None, ne_left=None, \
+                    anchors=None):
+        """
+            Args:
+                fstG: tag grammar fst
+                fstG_subgraph, Lfst_invert, user_graph: NE cascade fsts
+                helper: TagHelper, used to generate replace fst
+                syms_tb: final output word table (SymbolTable)
+                prune_opts: dict of prune_lattice() options applied to every hypothesis before composition,
+                            e.g. {"beam": 8.0, "max_states": 2000}
+                lazy: if True, the NE cascade is never composed, its shortest path is searched on the fly
+                lazy_max_states: expansion budget of the on-the-fly search
+                ne_graph: precomposed NE cascade (see UserGraphStore), the three NE fsts are not used then
+                user_custom: UserCustomGraph of the user table, if given user_graph may be None, a tiny user graph
+                             is built for every hypothesis from the entries its phonetic index retrieves,
+                             Lfst (phone-in/wd-out) must be given as well.
+                             UserCustomGraph.add_entry()/remove_entry() are only followed in this mode,
+                             i.e. load_pipeline(config, candidates=True), the precomposed user_graph
+                             has to be rebuilt after the user table changes
+                ne_left: precomposed fstG_subgraph o Lfst_invert of user_custom mode, shared by many pipelines
+                         (see UserGraphStore)
+                anchors: word ids of TagHelper.grammar_anchors(), hypotheses without any of them can not match
+                         the grammar and are returned without correction, None to correct every hypothesis
+        """
+        self.fstG = fstG
+        self.lazy = lazy and ne_graph is None and user_custom is None
+        self.lazy_max_states = lazy_max_states
+        self.user_custom = user_custom
+        if ne_graph is not None:
+            self.ne_graph = ne_graph
+        elif user_custom is not None:
+            self.ne_graph = None
+            # the sigma-star filters outside the slot accept any hypothesis word, not only lexicon words
+            if ne_left is None:
+                fstG_subgraph = helper.specialize(fstG_subgraph, helper.sigma_ids)
+                ne_left = compose(fstG_subgraph, Lfst_invert)
+            self.ne_left = arcsort_static(ne_left, "ilabel")
+            self.Lfst = arcsort_static(Lfst, "ilabel")
+            # full user graph, see full_user_graph()
+            self.user_graph = user_graph
+            self.user_graph_version = user_custom.version
+            if user_custom.index is None:
+                user_custom.build_index()
+        elif lazy:
+            self.ne_graph = None
+            self.cascade = LazyCascade(fstG_subgraph, Lfst_invert, user_graph, \
+                                        sigma_label=helper.sigma_label, sigma_ids=helper.sigma_ids)
+        else:
+            # the sigma-star filters outside the slot accept any hypothesis word, not only lexicon words
+            fstG_subgraph = helper.specialize(fstG_subgraph, helper.sigma_ids)
+            self.ne_graph = arcsort_static(compose(compose(fstG_subgraph, Lfst_invert), user_graph), "ilabel")
+        self.helper = helper
+        # words added later by user_custom.add_entry() are only in its own table
+        self.syms_tb = syms_tb if user_custom is None else user_custom.wd_table
+        self.nonterminal_in = nonterminal_in
+        self.nonterminal_out = nonterminal_out
+        self.prune_opts = prune_opts
+        self.anchors = anchors
+        self.anchor_stats = {"hypotheses": 0, "skipped": 0}
+        self.prune_stats = {"lattices": 0, "states_in": 0, "arcs_in": 0, "states_removed": 0, "arcs_removed": 0}
+
+    @classmethod
+    def from_graphs(cls, graphs, helper, **kwargs):
+        """
+            graphs: dict returned by build_graphs()
+        """
+        if kwargs.get("user_custom") is not None:
+            kwargs.setdefault("Lfst", graphs["Lfst"])
+
+        return cls(graphs["fstG"], graphs["fstG_subgraph"], graphs["Lfst_invert"], graphs["user_graph"], \
+                    helper, graphs["words_user"], **kwargs)
+
+    def prune(self, hyp_fst):
+        """
+            prune hypothesis by prune_opts and accumulate the statistics in self.prune_stats
+        """
+        hyp_fst, stats = prune_lattice(hyp_fst, **self.prune_opts)
+        self.prune_stats["lattices"] += 1
+        for key in ["states_in", "arcs_in", "states_removed", "arcs_removed"]:
+            self.prune_stats[key] += stats[key]
+
+        return hyp_fst
+
+    def preload(self):
+        """
+            load now what requests would load on first use, call it before forking workers so they share it.
+            Replace fsts of process() only hold ASCII labels, the tokenizer is only needed to segment the
+            user phrases of user_custom which are not a word (full_user_graph(), add_entry()).
+        """
+        if self.user_custom is not None and self.user_custom.unsegmented_phrases():
+            self.user_custom.segment_phrases()
+
+    def full_user_graph(self):
+        """
+            full user graph of user_custom, built on first use and rebuilt after its add_entry()/remove_entry()
+        """
+        user_custom = self.user_custom
+        if self.user_graph is None or self.user_graph_version != user_custom.version:
+            self.user_graph = arcsort_static(union(compose(self.Lfst, user_custom.contextFST()), \
+                                                user_custom.soundslikeFST(), user_custom.ipaFST()), "ilabel")
+            self.user_graph_version = user_custom.version
+
+        return self.user_graph
+
+    @metrics.timed("candidate_result", fst_in=1)
+    def candidate_result(self, hyp_fst, nshortest=1):
+        """
+            NE result of hyp_fst with the per-request user graph of user_custom,
+            as same as get_result(hyp_fst, ne_graph) with the full user graph
+        """
+        # empty parts are kept empty, the hypothesis is the result only if all of them are, like compose() does
+        phones = compose(hyp_fst, self.ne_left, fallback="empty") # wd-in/ph-out, the NE slot of hypothesis
+        words = compose(phones, self.Lfst, fallback="empty") # homophone words of the slot
+        graphs = self.user_custom.candidate_graphs(words, phones)
+        ne_result = compose(words, graphs["context"], fallback="empty")
+        # soundslike and ipa are composed only if some of their entries are retrieved
+        phone_graphs = [ graphs[kind] for kind in ("soundslike", "ipa") if graphs[kind].num_arcs(0) > 0 ]
+        if phone_graphs:
+            ne_result = union(ne_result, compose(phones, union(*phone_graphs).arcsort("ilabel"), fallback="empty"))
+
+        return get_result(hyp_fst if is_empty(ne_result) else ne_result, nshortest=nshortest)
+
+    @metrics.timed("process", fst_in=1)
+    def process(self, hyp_fst, nshortest=1, beam=None):
+        """
+            Input:
+                hyp_fst: hypothesis fst
+                nshortest: number of corrected paths to keep, use nbest_paths() to read them with weights
+                beam: if given, return the corrected lattice pruned by beam
+            Return:
+                corrected fst (best path, n best paths or pruned lattice)
+        """
+        if self.prune_opts is not None:
+            hyp_fst = self.prune(hyp_fst)
+        if self.anchors is not None:
+            self.anchor_stats["hypotheses"] += 1
+            if self.anchors.isdisjoint(fst_labels(hyp_fst, "output")):
+                # as same as the fallback of all compositions below, without running them
+                self.anchor_stats["skipped"] += 1
+                return get_result(hyp_fst.copy(), nshortest=nshortest, beam=beam)
+        # hypothesis is the left operand of two compositions, sort it once instead of in each of them
+        if not is_arcsorted(hyp_fst, "olabel"):
+            hyp_fst = hyp_fst.copy().arcsort("olabel")
+
+        # compact sigma-star is expanded only over the words of this hypothesis
+        tag_hyp = compose(hyp_fst, self.helper.specialize(self.fstG, fst_labels(hyp_fst, "output")))
+        if self.lazy:
+            if nshortest > 1:
+                raise ValueError("n-best is not supported in lazy mode")
+            ne_result = self.cascade.shortestpath(hyp_fst, nstate=self.lazy_max_states)
+        elif self.user_custom is not None:
+            ne_result = self.candidate_result(hyp_fst, nshortest=nshortest)
+        else:
+            ne_result = get_result(hyp_fst, self.ne_graph, nshortest=nshortest)
+        Rfst = self.helper.generate_replace_fst(ne_result, nonterminal_in=self.nonterminal_in, \
+                                                nonterminal_out=self.nonterminal_out, syms_tb=self.syms_tb, nshortest=nshortest)
+        Rfst = self.helper.specialize(Rfst, fst_labels(tag_hyp, "output"))
+
+        return get_result(tag_hyp, Rfst, nshortest=nshortest, beam=beam)
+
+    def streaming(self, **kwargs):
+        """
+            StreamingCorrector sharing the graphs of this pipeline, one per concurrent stream.
+            With user_custom the stream walks the full user graph (full_user_graph()), built on the first call.
+            kwargs: StreamingCorrector options, e.g. bos, eos, beam, max_tokens
+        """
+        if self.lazy:
+            ne_graphs = self.cascade.graphs
+        elif self.user_custom is not None:
+            # rebuilt after user table changes, the per-request candidate graphs need the whole hypothesis
+            ne_graphs = lambda: [self.ne_left, self.full_user_graph()]
+        else:
+            ne_graphs = [self.ne_graph]
+
+        return StreamingCorrector(self.fstG, ne_graphs, self.helper, self.syms_tb, nonterminal_in=self.nonterminal_in, \
+                                    nonterminal_out=self.nonterminal_out, **kwargs)
+
+    def process_batch(self, x, nshortest=1, beam=None):
+        """
+            Input:
+                x: list of hypothesis fst
+            Return:
+                list of corrected fst, same order as input
+        """
+        return [ self.process(hyp_fst, nshortest=nshortest, beam=beam) for hyp_fst in x ]
+
+    def process_text(self, x):
+        """
+            Input:
+                x: hypothesis string, words must be in syms_tb
+            Return:
+                corrected string
+        """
+        hyp_fst = read_string_as_fst(sym2int(x, self.syms_tb))
+
+        return int2sym(fst_to_linear_sequence(self.process(hyp_fst)), self.syms_tb)
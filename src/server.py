@@ -0,0 +1,254 @@
+# Copyright 2020 (author: Meng Wu)
+
+import os
+import json
+import time
+import base64
+import signal
+import asyncio
+import multiprocessing
+import concurrent.futures
+import pynini
+from .pipeline import load_pipeline
+from .common import fst_to_linear_sequence
+from .utils import int2sym
+
+# pipeline of this worker process, set by worker_init()
+_worker = {}
+
+
+def worker_init(config, pipeline_opts):
+    """
+        process pool initializer, graphs are loaded from GraphCache only if they are not inherited by fork
+    """
+    # the parent handles Ctrl-C and shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if "pipeline" not in _worker:
+        _worker["pipeline"] = load_pipeline(config, **pipeline_opts)
+
+
+def worker_process(batch):
+    """
+        correct one batch of requests in a worker process
+        Input:
+            batch: list of dict, {"text": hypothesis string} or {"fst": base64 of serialized fst}
+        Return:
+            list of dict {"text": corrected string, "process_ms": float} or {"error": message}
+    """
+    pipeline = _worker["pipeline"]
+    results = []
+    for request in batch:
+        _start = time.time()
+        try:
+            if "fst" in request:
+                hyp_fst = pynini.Fst.read_from_string(base64.b64decode(request["fst"]))
+                text = int2sym(fst_to_linear_sequence(pipeline.process(hyp_fst)), pipeline.syms_tb)
+            else:
+                text = pipeline.process_text(request["text"])
+            results.append({"text": text, "process_ms": (time.time() - _start) * 1000})
+        except Exception as e:
+            results.append({"error": "{}: {}".format(type(e).__name__, e)})
+
+    return results
+
+
+class BrownieServer():
+    """
+        Long-lived correction service.
+        Requests are queued, grouped into batches of up to max_batch (waiting at most max_wait seconds for
+        a batch to fill) and dispatched to a pool of worker processes, each holding its own pipeline.
+        When max_pending requests are already waiting, new ones are rejected with 503 instead of queued.
+        Protocol is HTTP/1.1 with JSON body, served on localhost TCP or on a Unix socket:
+            POST /correct  {"text": "..."} or {"fst": "<base64>"} or {"texts": [...]} or {"fsts": [...]}
+            GET  /health
+            GET  /stats
+    """
+    def __init__(self, config, workers=None, max_batch=16, max_wait=0.005, max_pending=1024, pipeline_opts=None):
+        """
+            Args:
+                config: dict like pipeline.default_config()
+                workers: number of worker processes, os.cpu_count() if None
+                pipeline_opts: BrowniePipeline options
+        """
+        self.config = config
+        self.workers = workers or os.cpu_count()
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.pipeline_opts = pipeline_opts or {}
+        self.pool = None
+        self.queue = None
+        self.stats = {"requests": 0, "rejected": 0, "errors": 0, "batches": 0, "batched_requests": 0}
+
+    def start_pool(self):
+        # graphs are loaded (and missing stages compiled) once here, forked workers share them copy-on-write
+        _worker["pipeline"] = load_pipeline(self.config, **self.pipeline_opts)
+        _worker["pipeline"].preload()
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=context, \
+                                                            initializer=worker_init, initargs=(self.config, self.pipeline_opts))
+        # start all workers now instead of on the first requests
+        list(self.pool.map(worker_process, [ [] for _ in range(self.workers) ]))
+
+    async def submit(self, requests):
+        """
+            queue requests and wait for their results
+            Return:
+                list of result dict, None if the server is busy
+        """
+        if self.queue.qsize() + len(requests) > self.max_pending:
+            self.stats["rejected"] += len(requests)
+            return None
+
+        loop = asyncio.get_running_loop()
+        futures = []
+        for request in requests:
+            future = loop.create_future()
+            self.queue.put_nowait((request, future, time.time()))
+            futures.append(future)
+        self.stats["requests"] += len(requests)
+
+        return await asyncio.gather(*futures)
+
+    async def batcher(self):
+        """
+            collect batches from queue and send them to the pool, at most 2 batches per worker in flight
+        """
+        loop = asyncio.get_running_loop()
+        in_flight = asyncio.Semaphore(self.workers * 2)
+        while True:
+            items = [ await self.queue.get() ]
+            deadline = loop.time() + self.max_wait
+            while len(items) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await in_flight.acquire()
+            self.stats["batches"] += 1
+            self.stats["batched_requests"] += len(items)
+            task = loop.run_in_executor(self.pool, worker_process, [ request for request, _, _ in items ])
+            task.add_done_callback(lambda task, items=items: self.finish_batch(task, items, in_flight))
+
+    def finish_batch(self, task, items, in_flight):
+        in_flight.release()
+        _end = time.time()
+        if task.exception() is not None:
+            results = [ {"error": "{}: {}".format(type(task.exception()).__name__, task.exception())} ] * len(items)
+        else:
+            results = task.result()
+
+        for (_, future, _start), result in zip(items, results):
+            if "error" in result:
+                self.stats["errors"] += 1
+            else:
+                result = dict(result, total_ms=(_end - _start) * 1000)
+            if not future.done():
+                future.set_result(result)
+
+    async def handle_correct(self, body):
+        """
+            Return:
+                (status, response dict)
+        """
+        try:
+            request = json.loads(body.decode("utf-8"))
+        except ValueError:
+            return 400, {"error": "invalid json"}
+        if not isinstance(request, dict):
+            return 400, {"error": "request must be a json object"}
+
+        if "texts" in request or "fsts" in request:
+            for key in ["texts", "fsts"]:
+                if not isinstance(request.get(key, []), list) or not all(isinstance(x, str) for x in request.get(key, [])):
+                    return 400, {"error": "{} must be a list of strings".format(key)}
+            requests = [ {"text": x} for x in request.get("texts", []) ] + [ {"fst": x} for x in request.get("fsts", []) ]
+        elif "text" in request or "fst" in request:
+            key = "fst" if "fst" in request else "text"
+            if not isinstance(request[key], str):
+                return 400, {"error": "{} must be a string".format(key)}
+            requests = [ {key: request[key]} ]
+        else:
+            return 400, {"error": "text, texts, fst or fsts must be given"}
+
+        results = await self.submit(requests)
+        if results is None:
+            return 503, {"error": "server busy"}
+        if "texts" in request or "fsts" in request:
+            return 200, {"results": results}
+
+        return (400 if "error" in results[0] else 200), results[0]
+
+    async def handle_connection(self, reader, writer):
+        """
+            minimal HTTP/1.1 with keep-alive
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, value = line.decode("latin-1").split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                if method == "POST" and path == "/correct":
+                    status, response = await self.handle_correct(body)
+                elif method == "GET" and path == "/health":
+                    status, response = 200, {"status": "ok"}
+                elif method == "GET" and path == "/stats":
+                    status, response = 200, dict(self.stats, pending=self.queue.qsize(), workers=self.workers)
+                else:
+                    status, response = 404, {"error": "not found"}
+
+                payload = json.dumps(response, ensure_ascii=False).encode("utf-8")
+                reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 503: "Service Unavailable"}[status]
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n".format( \
+                                status, reason, len(payload)).encode("latin-1") + payload)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8080, unix_socket=None):
+        """
+            run until cancelled, listen on unix_socket if given else on host:port
+        """
+        self.queue = asyncio.Queue()
+        if self.pool is None:
+            self.start_pool()
+
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+
+        batcher = asyncio.ensure_future(self.batcher())
+        # stop serving on SIGTERM as on Ctrl-C
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.pool.shutdown()
+            if unix_socket is not None and os.path.exists(unix_socket):
+                os.remove(unix_socket)
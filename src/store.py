@@ -0,0 +1,193 @@
+# Copyright 2020 (author: Meng Wu)
+
+import os
+import shutil
+import hashlib
+import collections
+from .user_ne import UserTableReader, UserCustomGraph
+from .tokenizer import get_tokenizer
+from .pipeline import BrowniePipeline
+from .common import compose, arcsort_static
+
+
+class UserGraphStore():
+    """
+        Per-user NE graphs for serving many users, each with its own user table.
+        Static pieces (Lfst, fstG, fstG_subgraph o Lfst_invert, word/phone tables, tokenizer) are loaded
+        once and shared by all users. A user is only its user table and the phonetic index over it,
+        its pipelines build a tiny user graph per request (see BrowniePipeline user_custom), so nothing
+        of vocabulary size is built or stored per user.
+        Users are kept in a LRU bounded by max_bytes, the least recently used ones are written into
+        store_dir when evicted and reloaded from there on the next request.
+        Layout:
+            <store_dir>/<sha1 of user id>/user_table.txt
+    """
+    def __init__(self, graphs, helper, phones, zh_syllable, jieba_lex=None, store_dir=None, max_bytes=1 << 30):
+        """
+            Args:
+                graphs: dict returned by build_graphs()
+                helper: TagHelper
+                phones, zh_syllable, jieba_lex: file paths
+                store_dir: where cold users are persisted, None to drop them
+                max_bytes: memory budget of user tables and their indexes (estimated by entries and n-grams)
+        """
+        self.helper = helper
+        self.fstG = graphs["fstG"]
+        self.Lfst = arcsort_static(graphs["Lfst"], "ilabel")
+        self.words = graphs["words_tag"]
+        reader = UserTableReader(wd_table_path=self.words, phone_table_path=phones, zh_syllable_table_path=zh_syllable)
+        self.phones = reader.phone_table
+        self.zh_syllable = reader.zh_syllable_table
+        self.tokenizer = get_tokenizer(backend="jieba", jieba_dict=jieba_lex)
+
+        # left part of the NE cascade, as same as BrowniePipeline composes for one user
+        fstG_subgraph = helper.specialize(graphs["fstG_subgraph"], helper.sigma_ids)
+        self.ne_left = arcsort_static(compose(fstG_subgraph, graphs["Lfst_invert"]), "ilabel")
+
+        self.store_dir = store_dir
+        if store_dir is not None:
+            os.makedirs(store_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = collections.OrderedDict() # {user_id: entry}, least recently used first
+        self.reader = reader
+        self.stats = {"hits": 0, "disk_loads": 0, "builds": 0, "evictions": 0}
+
+    def user_dir(self, user_id):
+        return os.path.join(self.store_dir, hashlib.sha1(str(user_id).encode("utf-8")).hexdigest())
+
+    def entry_size(self, user_custom):
+        """
+            estimated memory of one entry in bytes
+        """
+        num_grams = sum(len(grams) for _, grams in user_custom.index.grams.values())
+        num_symbols = len(user_custom.wd_table.sym2id)
+
+        return len(user_custom.user_dct) * 512 + num_grams * 128 + num_symbols * 128
+
+    def build(self, user_table):
+        """
+            read and index one user table
+            Return:
+                entry: dict of {"user_custom": indexed UserCustomGraph, "saved": version written into store_dir}
+        """
+        user_custom = UserCustomGraph(user_table, self.words, self.phones, self.zh_syllable, tokenizer=self.tokenizer)
+        user_custom.build_index()
+
+        return {"user_custom": user_custom, "saved": None}
+
+    def is_dirty(self, entry):
+        """
+            the user table changed since it was written, add_entry()/remove_entry() bump its version
+        """
+        return entry["saved"] != entry["user_custom"].version
+
+    def save(self, user_id, entry):
+        user_dir = self.user_dir(user_id)
+        tmp_dir = "{}.tmp{}".format(user_dir, os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        self.reader.write_user_table(entry["user_custom"].user_dct, os.path.join(tmp_dir, "user_table.txt"))
+
+        shutil.rmtree(user_dir, ignore_errors=True)
+        os.rename(tmp_dir, user_dir)
+        entry["saved"] = entry["user_custom"].version
+
+    def load(self, user_id):
+        """
+            Return:
+                entry persisted in store_dir, None if not found
+        """
+        if self.store_dir is None:
+            return None
+
+        user_table = os.path.join(self.user_dir(user_id), "user_table.txt")
+        if not os.path.isfile(user_table):
+            return None
+
+        entry = self.build(user_table)
+        entry["saved"] = entry["user_custom"].version
+
+        return entry
+
+    def insert(self, user_id, entry):
+        entry["size"] = self.entry_size(entry["user_custom"])
+        self.entries[user_id] = entry
+        self.nbytes += entry["size"]
+
+        # the newest entry is always kept even if it alone exceeds the budget
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            old_id, old_entry = self.entries.popitem(last=False)
+            self.nbytes -= old_entry["size"]
+            self.stats["evictions"] += 1
+            if self.store_dir is not None and self.is_dirty(old_entry):
+                self.save(old_id, old_entry)
+
+    def get(self, user_id, user_table=None):
+        """
+            Input:
+                user_id: any hashable id
+                user_table: user table path, needed only if the user is neither in memory nor in store_dir
+            Return:
+                entry: dict of {"user_custom": UserCustomGraph, ...}
+        """
+        if user_id in self.entries:
+            self.entries.move_to_end(user_id)
+            self.stats["hits"] += 1
+            return self.entries[user_id]
+
+        entry = self.load(user_id)
+        if entry is not None:
+            self.stats["disk_loads"] += 1
+        elif user_table is not None:
+            entry = self.build(user_table)
+            self.stats["builds"] += 1
+        else:
+            raise KeyError("user {} is not in store, user_table must be given".format(user_id))
+
+        self.insert(user_id, entry)
+
+        return entry
+
+    def put(self, user_id, user_table):
+        """
+            (re)load a user from its user table, the old entry in memory and store_dir is replaced
+        """
+        self.invalidate(user_id)
+        entry = self.build(user_table)
+        self.stats["builds"] += 1
+        self.insert(user_id, entry)
+
+        return entry
+
+    def invalidate(self, user_id):
+        if user_id in self.entries:
+            self.nbytes -= self.entries.pop(user_id)["size"]
+        if self.store_dir is not None:
+            shutil.rmtree(self.user_dir(user_id), ignore_errors=True)
+
+    def flush(self):
+        """
+            persist all in-memory entries which are not written yet
+        """
+        if self.store_dir is None:
+            return
+
+        for user_id, entry in self.entries.items():
+            if self.is_dirty(entry):
+                self.save(user_id, entry)
+
+    def pipeline(self, user_id, user_table=None, **kwargs):
+        """
+            BrowniePipeline of one user, sharing fstG and helper with all other users
+            kwargs: BrowniePipeline options, e.g. prune_opts, nonterminal_in/out
+        """
+        entry = self.get(user_id, user_table)
+
+        return BrowniePipeline(self.fstG, None, None, None, self.helper, None, user_custom=entry["user_custom"], \
+                                Lfst=self.Lfst, ne_left=self.ne_left, **kwargs)
+
+    def __contains__(self, user_id):
+        return user_id in self.entries or (self.store_dir is not None and os.path.isdir(self.user_dir(user_id)))
+
+    def __len__(self):
+        return len(self.entries)
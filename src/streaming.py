@@ -0,0 +1,189 @@
+# Copyright 2020 (author: Meng Wu)
+
+from .cascade import LazyCascade
+from .utils import int2sym
+
+
+class StreamingCorrector():
+    """
+        Correct a hypothesis while its words are still arriving (online ASR partial results).
+        fstG and the NE cascade are walked by token passing (LazyCascade.step), their tokens are kept
+        between chunks so every new word costs one step instead of composing the whole hypothesis again.
+        Words are emitted as soon as they are stable:
+            words outside the slot are emitted once all grammar tokens agree on them, they are never changed;
+            the slot is emitted corrected once all grammar tokens agree it is closed (nonterminal_out resolved),
+            for grammar.txt rules ending with "</CONTACT> </s>" that is when </s> arrives.
+        finish() closes the hypothesis and returns the whole corrected string, it only adds final weights
+        to the tokens, so the result is ready right after the last word.
+        Note:
+            The NE cascade is decided when the slot is closed, words after it are deleted by fstG_subgraph
+            with zero weight (read_sub_graph_grammar) and can not change the decision.
+            Emitted words are never taken back, so once a slot has been emitted the stream can disagree
+            with process() of the whole hypothesis, e.g. if the grammar fails after the slot the emitted
+            slot is kept, while process() would return the uncorrected hypothesis.
+            User table changes (UserCustomGraph.add_entry()/remove_entry()) are seen from the next reset().
+    """
+    def __init__(self, fstG, ne_graphs, helper, syms_tb, nonterminal_in="<CONTACT>", nonterminal_out="</CONTACT>", \
+                    bos="<s>", eos="</s>", beam=None, max_tokens=None):
+        """
+            Args:
+                fstG: tag grammar fst
+                ne_graphs: list of fsts of the NE cascade, [fstG_subgraph, Lfst_invert, user_graph] or [ne_graph],
+                           or a function returning it, called by every reset() to follow user table changes
+                helper: TagHelper, its sigma_label / sigma_ids resolve compact sigma-star arcs
+                syms_tb: word table (SymbolTable) of input and output words
+                bos, eos: words added by reset() and finish(), None if the caller sends them
+                beam, max_tokens: token pruning of LazyCascade.step()
+        """
+        self.tagger = LazyCascade(fstG, sigma_label=helper.sigma_label, sigma_ids=helper.sigma_ids)
+        self.ne_graphs = ne_graphs
+        self.helper = helper
+        self.ne = None
+        self.syms_tb = syms_tb
+        self.tag_in = syms_tb[nonterminal_in]
+        self.tag_out = syms_tb[nonterminal_out]
+        self.bos = bos
+        self.eos = eos
+        self.beam = beam
+        self.max_tokens = max_tokens
+        self.reset()
+
+    def reset(self):
+        """
+            start a new hypothesis
+        """
+        ne_graphs = self.ne_graphs() if callable(self.ne_graphs) else self.ne_graphs
+        if self.ne is None or any(a is not b for a, b in zip(self.ne.graphs, ne_graphs)):
+            self.ne = LazyCascade(*ne_graphs, sigma_label=self.helper.sigma_label, sigma_ids=self.helper.sigma_ids)
+        self.tag_tokens = self.tagger.start_tokens()
+        self.ne_tokens = self.ne.start_tokens()
+        self.hyp = [] # best input word of each position, the result if grammar fails
+        self.output = [] # emitted word labels
+        self.consumed = 0 # labels of the agreed grammar output already walked through
+        self.positions = 0 # hypothesis positions covered by emitted words
+        self.in_slot = False
+        self.slot_len = 0
+        self.passthrough = False # grammar failed, words are emitted as they are
+        self.finished = False
+        if self.bos is not None:
+            self.push([self.bos])
+
+    def alternatives(self, item):
+        """
+            one hypothesis position: word, label, or list of (word or label, weight)
+        """
+        if isinstance(item, (list, tuple)):
+            return [ (self.label(word), float(weight)) for word, weight in item ]
+
+        return [(self.label(item), 0.)]
+
+    def label(self, word):
+        return word if isinstance(word, int) else self.syms_tb[word]
+
+    def words(self, labels):
+        return int2sym(" ".join(str(label) for label in labels), self.syms_tb)
+
+    def push(self, words):
+        """
+            Input:
+                words: new hypothesis positions, each one is a word, a label or a list of (word, weight) alternatives
+            Return:
+                list of newly stable output words
+        """
+        if self.finished:
+            raise ValueError("hypothesis is finished, call reset() first")
+
+        start = len(self.output)
+        for item in words:
+            labels = self.alternatives(item)
+            self.hyp.append(min(labels, key=lambda alt: alt[1])[0])
+            if self.passthrough:
+                continue
+            self.tag_tokens = self.tagger.step(self.tag_tokens, labels, beam=self.beam, max_tokens=self.max_tokens)
+            if self.ne_tokens:
+                self.ne_tokens = self.ne.step(self.ne_tokens, labels, beam=self.beam, max_tokens=self.max_tokens)
+            if not self.tag_tokens:
+                self.passthrough = True
+
+        if self.passthrough:
+            self.emit_hyp()
+        else:
+            self.walk(self.common_output())
+
+        return self.words(self.output[start:]).split()
+
+    def emit_hyp(self):
+        self.output.extend(self.hyp[self.positions:])
+        self.positions = len(self.hyp)
+
+    def common_output(self):
+        """
+            longest common prefix of the grammar outputs of all tokens
+        """
+        outputs = iter(self.tagger.token_outputs(self.tag_tokens))
+        common = next(outputs)
+        for output in outputs:
+            n = 0
+            for a, b in zip(common, output):
+                if a != b:
+                    break
+                n += 1
+            common = common[:n]
+
+        return common
+
+    def walk(self, labels, final=False):
+        """
+            emit the grammar output labels after self.consumed, the slot is replaced by the NE result
+        """
+        for label in labels[self.consumed:]:
+            if label == self.tag_in:
+                self.in_slot = True
+                self.slot_len = 0
+            elif label == self.tag_out:
+                self.in_slot = False
+                self.output.extend(self.slot_result(final))
+                self.positions += self.slot_len
+            elif self.in_slot:
+                self.slot_len += 1
+            else:
+                self.output.append(label)
+                self.positions += 1
+            self.consumed += 1
+
+    def slot_result(self, final):
+        best = self.ne.best_token(self.ne_tokens, final=final)
+        if best is None:
+            # NE cascade fails, the slot is left as it is
+            return self.hyp[self.positions:self.positions + self.slot_len]
+
+        return best[1]
+
+    def finish(self, words=None):
+        """
+            Input:
+                words: last hypothesis positions, see push()
+            Return:
+                corrected string of the whole hypothesis
+        """
+        if words:
+            self.push(words)
+        if self.eos is not None:
+            self.push([self.eos])
+        self.finished = True
+
+        best = None if self.passthrough else self.tagger.best_token(self.tag_tokens, final=True)
+        if best is None:
+            # grammar does not accept the hypothesis
+            self.emit_hyp()
+        else:
+            self.walk(best[1], final=True)
+
+        return self.words(self.output)
+
+    def stable(self):
+        """
+            Return:
+                emitted output words so far
+        """
+        return self.words(self.output).split()
@@ -1,9 +1,93 @@
 # Copyright 2020 (author: Meng Wu)
 
+import os
+import marshal
+import tempfile
+import collections
 import jieba
 import jieba.posseg as pseg
+from .utils import file_hash
+from . import metrics
 #import hanlp
 
+# shared Tokenizer of each (backend, dictionary), see get_tokenizer()
+_tokenizers = {}
+# cache_dir of get_tokenizer() when not given, see set_cache_dir()
+_default_cache_dir = None
+# use_dictionary() fills jieba.dt fields directly, which is only checked against this jieba version
+JIEBA_VERSION = "0.42.1"
+
+
+def set_cache_dir(cache_dir):
+    '''
+        directory of the prefix dictionary cache of tokenizers created later by get_tokenizer(),
+        set by build_graphs() to a directory of its GraphCache. None disables the cache.
+    '''
+    global _default_cache_dir
+    _default_cache_dir = cache_dir
+
+
+def use_dictionary(dict_file, cache_dir=None):
+    '''
+        set dict_file as the dictionary of jieba's global tokenizer and load it, nothing to do if it is already used.
+        The prefix dictionary is cached as jieba.<sha1 of dict_file>.marshal in cache_dir, it is built once for
+        a dictionary content and then only loaded, about 4x faster than jieba's own cache, which is also keyed
+        by path and mtime instead of content. marshal never runs code while loading, unlike pickle.
+        Without cache_dir, or with another jieba version than JIEBA_VERSION, jieba loads the dictionary itself.
+        A cache which can not be read or written is a cache miss.
+    '''
+    abs_path = os.path.abspath(dict_file)
+    if jieba.dt.dictionary == abs_path and jieba.dt.initialized:
+        return
+
+    jieba.set_dictionary(abs_path)
+    if cache_dir is None or jieba.__version__ != JIEBA_VERSION:
+        jieba.dt.initialize()
+        return
+
+    cache_file = os.path.join(cache_dir, "jieba.{}.marshal".format(file_hash(abs_path)))
+    try:
+        with open(cache_file, "rb") as f:
+            freq, total = marshal.loads(f.read())
+        if not isinstance(freq, dict) or not isinstance(total, int):
+            raise ValueError("bad cache")
+    except (OSError, EOFError, ValueError, TypeError):
+        freq, total = jieba.dt.gen_pfdict(jieba.dt.get_dict_file())
+        write_cache(cache_file, (freq, total))
+    jieba.dt.FREQ, jieba.dt.total = freq, total
+    jieba.dt.initialized = True
+
+
+def write_cache(cache_file, x):
+    '''
+        write and rename, concurrent processes never read a partial cache, failures are ignored
+    '''
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(cache_file), mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+        with os.fdopen(fd, "wb") as f:
+            marshal.dump(x, f)
+        os.replace(tmp_path, cache_file)
+    except OSError:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_tokenizer(backend="jieba", jieba_dict=None, cache_dir=None):
+    '''
+        process-wide Tokenizer, created and initialized on the first call for a dictionary, then shared.
+        Use it instead of Tokenizer() so the dictionary is loaded once per process.
+        cache_dir: see use_dictionary(), the one of set_cache_dir() if None
+    '''
+    key = (backend, os.path.abspath(jieba_dict) if jieba_dict is not None else None)
+    if key not in _tokenizers:
+        _tokenizers[key] = Tokenizer(backend=backend, jieba_dict=jieba_dict, cache_dir=cache_dir or _default_cache_dir)
+        if backend == "jieba" and jieba_dict is None:
+            jieba.dt.initialize()
+
+    return _tokenizers[key]
+
 
 class HanlpTokenizer():
 
@@ -44,13 +128,14 @@ class HanlpTokenizer():
 
 
 class JiebaTokenizer():
-    def __init__(self, dict_file=None, cut_all=False, hmm=False, tk_mode="default"):
+    def __init__(self, dict_file=None, cut_all=False, hmm=False, tk_mode="default", cache_dir=None):
         self.cut_all = cut_all
         self.hmm = hmm
         self.tk_mode = tk_mode
+        self.cache_dir = cache_dir
         
         if dict_file is not None:
-            jieba.set_dictionary(dict_file)
+            use_dictionary(dict_file, cache_dir)
 
         if tk_mode == "default":
             self.wd_pos = jieba.Tokenizer()
@@ -58,7 +143,7 @@ class JiebaTokenizer():
             self.ws_pos = pseg.POSTokenizer(jieba.dt)
 
     def reload_dict(self, dict_file):
-        jieba.set_dictionary(dict_file)
+        use_dictionary(dict_file, self.cache_dir)
         self.ws_pos = pseg.POSTokenizer()
 
     def segment(self, x, mode="segment"):
@@ -94,19 +179,58 @@ class JiebaTokenizer():
 
             return " ".join(seg_result)
 
+    def segment_batch(self, x, workers=None):
+        '''
+            segment many strings in "segment" mode by one jieba call over the newline-joined text,
+            same result as segment() for each of them since jieba never joins words across a line break.
+            Input:
+                x (list of string)
+                workers: if > 1, use jieba parallel mode with this number of processes (POSIX only)
+            Return:
+                list of segment (string)
+        '''
+        if any("\n" in i or "\r" in i for i in x):
+            return [ self.segment(i) for i in x ]
+
+        parallel = workers is not None and workers > 1 and os.name == "posix"
+        if parallel:
+            jieba.enable_parallel(workers)
+        try:
+            seg_result = jieba.lcut("\n".join(x))
+        finally:
+            if parallel:
+                jieba.disable_parallel()
+
+        result = []
+        cur = []
+        for i in seg_result:
+            if i == "\n":
+                result.append(" ".join(cur))
+                cur = []
+            else:
+                cur.append(i)
+        result.append(" ".join(cur))
+
+        return result
+
 
 class Tokenizer():
     '''
         Jieba/HanLP segmentor high level interface
+        Results are memorized in a LRU of cache_size strings, hit/miss counts are kept in self.stats.
+        cache_dir: where jieba's prefix dictionary cache is kept, see use_dictionary()
     '''
-    def __init__(self, backend="jieba", jieba_dict=None):
+    def __init__(self, backend="jieba", jieba_dict=None, cache_size=100000, cache_dir=None):
         self.backend = backend
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict() # {(mode, string): result}
+        self.stats = {"hits": 0, "misses": 0}
 
         if backend == "jieba":            
             if jieba_dict is not None:
-                self.segmenter = JiebaTokenizer(jieba_dict)
+                self.segmenter = JiebaTokenizer(jieba_dict, cache_dir=cache_dir)
             else:
-                self.segmenter = JiebaTokenizer()
+                self.segmenter = JiebaTokenizer(cache_dir=cache_dir)
         
         elif backend == "hanlp":
             self.segmenter = HanlpTokenizer()
@@ -122,6 +246,59 @@ class Tokenizer():
             Options:
                 mode: segment/segment_pos/seperate
         '''
-        segmenter = self.segmenter
+        key = (mode, x)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.stats["hits"] += 1
+            result = self.cache[key]
+        else:
+            self.stats["misses"] += 1
+            metrics.count("tokenizer_calls")
+            result = self.segmenter.segment(x, mode=mode)
+            self.remember(key, result)
+
+        # seperate mode result is a list, never give out the cached one
+        return list(result) if isinstance(result, list) else result
+
+    @metrics.timed("tokenizer.segment_batch")
+    def segment_batch(self, x, mode="segment", workers=None):
+        '''
+            segment many strings in one call, only the ones not in cache are segmented
+            Input:
+                x (list of string)
+                workers: number of jieba processes, see JiebaTokenizer.segment_batch
+            Return:
+                list of results, same order as x
+        '''
+        results = {}
+        missing = []
+        for i in x:
+            key = (mode, i)
+            if i in results:
+                continue
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.stats["hits"] += 1
+                results[i] = self.cache[key]
+            else:
+                results[i] = None
+                missing.append(i)
+
+        if len(missing) > 0:
+            self.stats["misses"] += len(missing)
+            metrics.count("tokenizer_calls", len(missing))
+            if mode == "segment" and self.backend == "jieba":
+                seg_result = self.segmenter.segment_batch(missing, workers=workers)
+            else:
+                seg_result = [ self.segmenter.segment(i, mode=mode) for i in missing ]
+
+            for i, result in zip(missing, seg_result):
+                results[i] = result
+                self.remember((mode, i), result)
+
+        return [ list(results[i]) if isinstance(results[i], list) else results[i] for i in x ]
 
-        return segmenter.segment(x, mode=mode)
\ No newline at end of file
+    def remember(self, key, result):
+        self.cache[key] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
\ No newline at end of file
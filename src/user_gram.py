@@ -3,9 +3,42 @@
 import pynini
 import itertools
 import re
+import time
+from array import array
 from .utils import DataIO, lex_add_disambig
-from .tokenizer import Tokenizer
-from .common import fst_to_linear_sequence
+from .tokenizer import get_tokenizer
+from .common import best_path, nbest_paths, expand_sigma, arrays2fst
+from . import metrics
+
+
+# label of compact sigma-star arcs (TagHelper(sigma="compact")), far above any word id
+SIGMA_LABEL = 1 << 30
+
+
+def read_grammar_anchors(x, word_tb):
+    """
+        words of grammar file which are neither tags, <SIGMA_STAR>, <s> nor </s>,
+        a hypothesis without any of them can not match the grammar
+        Input:
+            x: grammar file path
+            word_tb: SymbolTable, e.g. words_tag of build_graphs()
+        Return:
+            set of word ids, None if some rule has no anchor word (every hypothesis may match it)
+    """
+    anchors = set()
+    for grammar in DataIO().read_file_to_list(x):
+        # tags, <SIGMA_STAR>, <s> and </s> are all in angle brackets
+        words = [ j for j in grammar if not re.search("<.*>", j) ]
+        if len(words) == 0:
+            return None
+
+        for j in words:
+            try:
+                anchors.add(word_tb[j])
+            except:
+                raise ValueError(j, "is not in symbol tables")
+
+    return anchors
 
 
 class GrammarHelper():
@@ -15,20 +48,24 @@ class GrammarHelper():
         self.data_io = DataIO()
         self.word_tb = self.load_symbols(words)
         self.phone_tb = self.load_symbols(phones)
-        
-        # init tokenizer
-        if jieba_lex is not None:
-            self.tokenizer = Tokenizer(backend="jieba", jieba_dict=jieba_lex)
-        else:
-            self.tokenizer = Tokenizer(backend="jieba")
+        self.jieba_lex = jieba_lex
+        self._tokenizer = None
+
+    @property
+    def tokenizer(self):
+        # loaded on first use, helpers which only read cached graphs never need it
+        if self._tokenizer is None:
+            self._tokenizer = get_tokenizer(backend="jieba", jieba_dict=self.jieba_lex)
+
+        return self._tokenizer
 
     def load_symbols(self, symbol_table):
         '''
-            It's not a real symbol table.
             Assume symbols_tables as same form as Kaldi's words.txt and phones.txt
-            Then, convert text(string) to dict's key.
+            Return:
+                SymbolTable
         '''
-        wd_syms = self.data_io.read_word_table(symbol_table)
+        wd_syms = self.data_io.read_symbol_table(symbol_table)
 
         return wd_syms
 
@@ -36,24 +73,22 @@ class GrammarHelper():
         '''
             Input:
                 x: pair with dim 1 x 2, means input/output pair
-                in_syms: symbol table (dict)
-                out_syms: symbol table (dict)
+                in_syms: SymbolTable
+                out_syms: SymbolTable
             Return:
                 pynini.Fst object
         '''
 
-        tokenizer = self.tokenizer
-
-        # english split by space
+        # english split by space, the tokenizer is only loaded for non-ASCII strings
         if x[0].isascii():
             _in = x[0].strip().split(" ")
         else:
-            _in = tokenizer.segment(x[0]).split(" ")
+            _in = self.tokenizer.segment(x[0]).split(" ")
         
         if x[1].isascii():
             _out = x[1].strip().split(" ")
         else:
-            _out = tokenizer.segment(x[1]).split(" ")
+            _out = self.tokenizer.segment(x[1]).split(" ")
         
         _temp = [_in, _out]
         _fst = pynini.Fst()
@@ -69,19 +104,19 @@ class GrammarHelper():
             _arc_in, _arc_out = pair
             if in_syms is not None:
                 try:
-                    _arc_in = int(in_syms[_arc_in])
+                    _arc_in = in_syms[_arc_in]
                 except:
                     if _arc_in is None:
-                        _arc_in = int(in_syms["<eps>"])
+                        _arc_in = in_syms["<eps>"]
                     else:
                         raise ValueError("symbol not in symbol table")
         
             if out_syms is not None:
                 try:
-                    _arc_out = int(out_syms[_arc_out])
+                    _arc_out = out_syms[_arc_out]
                 except:
                     if _arc_out is None:
-                        _arc_out = int(out_syms["<eps>"])
+                        _arc_out = out_syms["<eps>"]
                     else:
                         raise ValueError("symbol not in symbol table")
             
@@ -94,258 +129,242 @@ class GrammarHelper():
 
         return _fst
 
-    def load_kaldi_lex_as_lfst(self, kaldi_lex, add_disambig=False, add_position=False, add_opt_sil="SIL", invert=False):
+    def read_kaldi_lex_arcs(self, kaldi_lex, add_disambig=False, add_position=False, add_opt_sil="SIL"):
         """
-            create lexicon fst with phone-in/words-out symbols
+            stream a Kaldi lexicon once and buffer the arcs of phone-in/word-out L.fst
+            State 0 is start state with an epsilon arc to state 1 (final), each word is a path from state 1 back to state 1,
+            so there is no epsilon loop to remove in optimize().
+            With add_disambig and add_opt_sil, words end in a shared state 2 which goes back to state 1
+            by epsilon or by optional silence followed by the last disambiguation symbol.
+            Return:
+                num_states: int
+                arcs: (src, dst, ilabel, olabel) arrays
         """
+        in_syms = self.phone_tb
+        out_syms = self.word_tb
+        _eps_in = in_syms["<eps>"]
+        _eps_out = out_syms["<eps>"]
+        src, dst, ilabels, olabels = array("l"), array("l"), array("l"), array("l")
+
+        def add_arc(_src, _dst, _arc_in, _arc_out):
+            src.append(_src)
+            dst.append(_dst)
+            ilabels.append(_arc_in)
+            olabels.append(_arc_out)
 
-        _opt_sil_state = ""
+        add_arc(0, 1, _eps_in, _eps_out)
+        num_states = 2
+        word_end = 1
 
         if add_disambig:
             _lex, ndis = lex_add_disambig(kaldi_lex)
-            _has_disambig = False # initial tag
+            _lex = ( line.strip().split() for line in _lex )
+
+            if add_opt_sil:
+                word_end = 2
+                add_arc(2, 1, _eps_in, _eps_out)
+                add_arc(2, 3, in_syms[add_opt_sil], _eps_out)
+                # return to state 1
+                add_arc(3, 1, in_syms["#" + str(ndis + 1)], _eps_out)
+                num_states = 4
         else:
-            _lex = self.data_io.read_file_to_list(kaldi_lex)
-
-        in_syms = self.phone_tb
-        out_syms = self.word_tb
-
-        _arc_weight = pynini.Weight("tropical", 0)
-        _lfst = pynini.Fst()
-        _lfst.add_state() # 0-state
-        cur_state = 0 # start from 0-based
+            _lex = self.data_io.iter_file_lines(kaldi_lex)
 
-        for idx, line in enumerate(_lex):
-            if add_disambig:
-                line = line.strip().split()
-
-            if idx == 0:
-                _arc_in = int(in_syms["<eps>"])
-                _arc_out = int(out_syms["<eps>"])
-                _lfst.add_state()
-                _lfst.add_arc(0, pynini.Arc(_arc_in, _arc_out, _arc_weight, 1))
-                _lfst.set_final(1)
-                cur_state = 1
+        for line in _lex:
+            if line == [""]:
+                continue
 
             _wd = line[0] # string
             _ph_seq = line[1:] # list
             if add_position:
-                if add_disambig and "#" in " ".join(_ph_seq):
+                _dis_symb = None
+                if add_disambig and _ph_seq[-1].startswith("#"):
                     _dis_symb = _ph_seq[-1]
                     _ph_seq = _ph_seq[:-1]
-                    _has_disambig = True
 
                 if len(_ph_seq) == 1:
                     _ph_seq = [ _ph_seq[0] + "_S" ]
                 else:
-                    for i, j in enumerate(_ph_seq):
-                        if i == 0:
-                            _ph_seq[i] = j + "_B"
-                        elif i == len(_ph_seq):
-                            _ph_seq[i] = j + "_E"
-                        else:
-                            _ph_seq[i] = j + "_I"
-                
-                if _has_disambig:
+                    _ph_seq = [ j + ("_B" if i == 0 else "_E" if i == len(_ph_seq) - 1 else "_I") for i, j in enumerate(_ph_seq) ]
+
+                if _dis_symb is not None:
                     _ph_seq.append(_dis_symb)
-                    _has_disambig = False
 
-            _temp = [ _ph_seq, _wd.split(" ") ]
-            for sub_idx, pair in enumerate(list(itertools.zip_longest(*_temp))):
-                _arc_in, _arc_out = pair
-                try:
-                    _arc_in = int(in_syms[_arc_in])
-                except:
+            cur_state = 1
+            n_arcs = max(len(_ph_seq), 1)
+            for sub_idx in range(n_arcs):
+                if sub_idx < len(_ph_seq):
+                    _arc_in = in_syms.get(_ph_seq[sub_idx])
                     if _arc_in is None:
-                        _arc_in = int(in_syms["<eps>"])
-                    else:
-                        raise ValueError(_arc_in, "this symbol not in input symbol table")
+                        raise ValueError(_ph_seq[sub_idx], "this symbol not in input symbol table")
+                else:
+                    _arc_in = _eps_in
 
-                try:
-                    _arc_out = int(out_syms[_arc_out])
-                except:
-                    if _arc_out is None:
-                        _arc_out = int(out_syms["<eps>"])
-                    else:
-                        raise ValueError(_arc_out, "this symbol not in output symbol table")
-                
-                _lfst.add_state()
                 if sub_idx == 0:
-                    # each word start from state 1
-                    _lfst.add_arc(1, pynini.Arc(_arc_in, _arc_out, _arc_weight, cur_state + 1))
+                    _arc_out = out_syms.get(_wd)
+                    if _arc_out is None:
+                        raise ValueError(_wd, "this symbol not in output symbol table")
                 else:
-                    _lfst.add_arc(cur_state, pynini.Arc(_arc_in, _arc_out, _arc_weight, cur_state + 1))
-                cur_state += 1
-
-            # return to state 1
-            _arc_in = int(in_syms["<eps>"])
-            _arc_out = int(out_syms["<eps>"])
-            _lfst.add_arc(cur_state, pynini.Arc(_arc_in, _arc_out, _arc_weight, 1))
-
-            if add_disambig and add_opt_sil:
-                if _opt_sil_state == "":
-                    _lfst.add_states(2)
-                    _arc_in = int(in_syms["SIL"])
-                    _arc_out = int(out_syms["<eps>"])
-                    _lfst.add_arc(cur_state, pynini.Arc(_arc_in, _arc_out, _arc_weight, cur_state + 1))
-                    _opt_sil_state = cur_state
-                    cur_state += 1
-                    _arc_in = int(in_syms["#" + str(ndis + 1)])
+                    _arc_out = _eps_out
+
+                if sub_idx == n_arcs - 1:
                     # return to state 1
-                    _lfst.add_arc(cur_state, pynini.Arc(_arc_in, _arc_out, _arc_weight, 1))
-                    cur_state += 1
+                    _next_state = word_end
                 else:
-                    _arc_in = int(in_syms["SIL"])
-                    _arc_out = int(out_syms["<eps>"])
-                    _lfst.add_arc(_opt_sil_state, pynini.Arc(_arc_in, _arc_out, _arc_weight, _opt_sil_state + 1))
-                    _arc_in = int(in_syms["#" + str(ndis + 1)])
-                    # return to state 1
-                    _lfst.add_arc(_opt_sil_state + 1, pynini.Arc(_arc_in, _arc_out, _arc_weight, 1))
- 
-        _lfst.set_start(0)
-
-        if invert:
-            _lfst.optimize()
-            _lfst.invert()
-            return _lfst
-        else:
-            return _lfst.optimize()
+                    _next_state = num_states
+                    num_states += 1
+
+                add_arc(cur_state, _next_state, _arc_in, _arc_out)
+                cur_state = _next_state
+
+        return num_states, (src, dst, ilabels, olabels)
+
+    def arcs_to_lfst(self, num_states, arcs, reverse=False):
+        """
+            compile buffered arcs of read_kaldi_lex_arcs() in one go
+            Args:
+                reverse: swap input and output labels, create word-in/phone-out fst
+        """
+        src, dst, ilabels, olabels = arcs
+        if reverse:
+            ilabels, olabels = olabels, ilabels
+
+        return arrays2fst(src, dst, ilabels, olabels, num_states=num_states, start=0, finals=(1,))
+
+    @metrics.timed("build_lexicon")
+    def build_lexicon(self, kaldi_lex, add_disambig=False, add_position=False, add_opt_sil="SIL", directions=("lfst",)):
+        """
+            read lexicon once and create the requested fsts from the same arc buffer
+            Args:
+                directions: tuple of
+                    lfst: phone-in/word-out
+                    invert: invert of optimized lfst
+                    reverse: word-in/phoneme-out built directly
+            Return:
+                dict {direction: fst}, build time and size are kept in self.lex_build_stats
+        """
+        _start = time.time()
+        num_states, arcs = self.read_kaldi_lex_arcs(kaldi_lex, add_disambig=add_disambig, add_position=add_position, add_opt_sil=add_opt_sil)
+        _read = time.time()
+
+        result = {}
+        if "lfst" in directions or "invert" in directions:
+            _lfst = self.arcs_to_lfst(num_states, arcs).optimize()
+            if "lfst" in directions:
+                result["lfst"] = _lfst
+            if "invert" in directions:
+                result["invert"] = _lfst.copy().invert() if "lfst" in directions else _lfst.invert()
+
+        if "reverse" in directions:
+            result["reverse"] = self.arcs_to_lfst(num_states, arcs, reverse=True).optimize()
+
+        _fst = list(result.values())[0]
+        self.lex_build_stats = {"read_time": _read - _start, "build_time": time.time() - _read, \
+                                "raw_states": num_states, "raw_arcs": len(arcs[0]), \
+                                "states": _fst.num_states(), "arcs": sum(_fst.num_arcs(state) for state in _fst.states())}
+
+        return result
+
+    def load_kaldi_lex_as_lfst(self, kaldi_lex, add_disambig=False, add_position=False, add_opt_sil="SIL", invert=False):
+        """
+            create lexicon fst with phone-in/words-out symbols
+        """
+        direction = "invert" if invert else "lfst"
+
+        return self.build_lexicon(kaldi_lex, add_disambig=add_disambig, add_position=add_position, \
+                                    add_opt_sil=add_opt_sil, directions=(direction,))[direction]
     
     def load_kaldi_lex_as_lfst_reverse(self, kaldi_lex, add_disambig=False, add_position=False, add_opt_sil="SIL"):
         """
             create lexicon fst with word-in/phoneme-out symbols
-            Note: optional silence still not tracking is correct or not.
         """
+        return self.build_lexicon(kaldi_lex, add_disambig=add_disambig, add_position=add_position, \
+                                    add_opt_sil=add_opt_sil, directions=("reverse",))["reverse"]
 
-        _opt_sil_state = ""
 
-        if add_disambig:
-            _lex, ndis = lex_add_disambig(kaldi_lex)
-            _has_disambig = False # initial tag
+class TagHelper(GrammarHelper):
+    def __init__(self, words, phones, jieba_lex=None, sigma="expand"):
+        """
+            Args:
+                sigma: (string) how sigma-star FSTs cover the vocabulary
+                    expand: one arc per word in word table
+                    compact: one arc with the special <SIGMA> label which matches any word,
+                             it is expanded by specialize() only over the labels of the fst being composed
+        """
+        super().__init__(words, phones, jieba_lex)
+        if sigma not in ["expand", "compact"]:
+            raise ValueError("sigma is only expand or compact")
+
+        self.sigma = sigma
+        # words covered by sigma-star, grammar tags and user words added later are not included
+        self.sigma_ids = frozenset(self.word_tb.values())
+        if sigma == "compact":
+            # not added into word_tb, so it never reaches words_tag / words_user or the passthrough of contextFST
+            self.sigma_label = SIGMA_LABEL
         else:
-            _lex = self.data_io.read_file_to_list(kaldi_lex)
+            self.sigma_label = None
 
-        in_syms = self.word_tb
-        out_syms = self.phone_tb
+        self.sigma_stars = {}
 
-        _arc_weight = pynini.Weight("tropical", 0)
-        _lfst = pynini.Fst()
-        _lfst.add_state() # 0-state
-        cur_state = 0 # start from 0-based
+    def sigma_star(self, name, builder):
+        """
+            sigma-star fsts are vocabulary-sized, they are built on first use
+        """
+        if name not in self.sigma_stars:
+            self.sigma_stars[name] = builder()
 
-        for idx, line in enumerate(_lex):
-            if add_disambig:
-                line = line.strip().split()
+        return self.sigma_stars[name]
 
-            if idx == 0:
-                _arc_in = int(in_syms["<eps>"])
-                _arc_out = int(out_syms["<eps>"])
-                _lfst.add_state()
-                _lfst.add_arc(0, pynini.Arc(_arc_in, _arc_out, _arc_weight, 1))
-                _lfst.set_final(1)
-                cur_state = 1
+    @property
+    def sigma_star_fst_1state(self):
+        return self.sigma_star("1state", self.gen_sigma_star_1state)
 
-            _wd = line[0] # string
-            _ph_seq = line[1:] # list
-            if add_position:
-                if add_disambig and "#" in " ".join(_ph_seq):
-                    _dis_symb = _ph_seq[-1]
-                    _ph_seq = _ph_seq[:-1]
-                    _has_disambig = True
+    @property
+    def sigma_star_fst_2state(self):
+        return self.sigma_star("2state", self.gen_sigma_star_2state)
 
-                if len(_ph_seq) == 1:
-                    _ph_seq = [ _ph_seq[0] + "_S" ]
-                else:
-                    for i, j in enumerate(_ph_seq):
-                        if i == 0:
-                            _ph_seq[i] = j + "_B"
-                        elif i == len(_ph_seq):
-                            _ph_seq[i] = j + "_E"
-                        else:
-                            _ph_seq[i] = j + "_I"
-                
-                if _has_disambig:
-                    _ph_seq.append(_dis_symb)
-                    _has_disambig = False
+    @property
+    def sigma_star_fst_1state_filter(self):
+        return self.sigma_star("1state_filter", self.gen_sigma_star_1state_filter)
 
-            _temp = [ _wd.split(" "), _ph_seq ]
-            for sub_idx, pair in enumerate(list(itertools.zip_longest(*_temp))):
-                _arc_in, _arc_out = pair
-                try:
-                    _arc_in = int(in_syms[_arc_in])
-                except:
-                    if _arc_in is None:
-                        _arc_in = int(in_syms["<eps>"])
-                    else:
-                        raise ValueError(_arc_in, "this symbol not in input symbol table")
+    @property
+    def sigma_star_fst_2state_filter(self):
+        return self.sigma_star("2state_filter", self.gen_sigma_star_2state_filter)
 
-                try:
-                    _arc_out = int(out_syms[_arc_out])
-                except:
-                    if _arc_out is None:
-                        _arc_out = int(out_syms["<eps>"])
-                    else:
-                        raise ValueError(_arc_out, "this symbol not in output symbol table")
-                
-                _lfst.add_state()
-                if sub_idx == 0:
-                    # each word start from state 1
-                    _lfst.add_arc(1, pynini.Arc(_arc_in, _arc_out, _arc_weight, cur_state + 1))
-                else:
-                    _lfst.add_arc(cur_state, pynini.Arc(_arc_in, _arc_out, _arc_weight, cur_state + 1))
-                cur_state += 1
-
-            # return to state 1
-            _arc_in = int(in_syms["<eps>"])
-            _arc_out = int(out_syms["<eps>"])
-            _lfst.add_arc(cur_state, pynini.Arc(_arc_in, _arc_out, _arc_weight, 1))
-
-            if add_disambig and add_opt_sil:
-                if _opt_sil_state == "":
-                    _lfst.add_states(2)
-                    _arc_in = int(in_syms["<eps>"])
-                    _arc_out = int(out_syms["SIL"])
-                    _lfst.add_arc(cur_state, pynini.Arc(_arc_in, _arc_out, _arc_weight, cur_state + 1))
-                    _opt_sil_state = cur_state
-                    cur_state += 1
-                    _arc_out = int(out_syms["#" + str(ndis + 1)])
-                    # return to state 1
-                    _lfst.add_arc(cur_state, pynini.Arc(_arc_in, _arc_out, _arc_weight, 1))
-                    cur_state += 1
-                else:
-                    _arc_in = int(in_syms["<eps>"])
-                    _arc_out = int(out_syms["SIL"])
-                    _lfst.add_arc(_opt_sil_state, pynini.Arc(_arc_in, _arc_out, _arc_weight, _opt_sil_state + 1))
-                    _arc_out = int(out_syms["#" + str(ndis + 1)])
-                    # return to state 1
-                    _lfst.add_arc(_opt_sil_state + 1, pynini.Arc(_arc_in, _arc_out, _arc_weight, 1))
- 
-        _lfst.set_start(0)
-
-        return _lfst.optimize()
+    def sigma_alphabet(self):
+        """
+            labels of sigma-star arcs
+        """
+        if self.sigma_label is not None:
+            _alphabet = [ self.sigma_label ]
+            if 0 in self.sigma_ids:
+                _alphabet.append(0)
+            return _alphabet
+        else:
+            # not word_tb, grammar tags are added into it later
+            return sorted(self.sigma_ids)
 
+    def specialize(self, fst, alphabet):
+        """
+            expand <SIGMA> arcs of fst over the given labels, nothing to do with expanded sigma-star
+            Input:
+                alphabet: labels of the other side of the composition, e.g. fst_labels(hyp_fst, "output")
+        """
+        if self.sigma_label is None:
+            return fst
 
-class TagHelper(GrammarHelper):
-    def __init__(self, words, phones, jieba_lex=None):
-        super().__init__(words, phones, jieba_lex)
-        self.sigma_star_fst_1state = self.gen_sigma_star_1state()
-        self.sigma_star_fst_2state = self.gen_sigma_star_2state()
-        self.sigma_star_fst_1state_filter = self.gen_sigma_star_1state_filter()
-        self.sigma_star_fst_2state_filter = self.gen_sigma_star_2state_filter()
+        return expand_sigma(fst, self.sigma_label, [ i for i in alphabet if i != 0 and i in self.sigma_ids ])
 
     def gen_sigma_star_1state(self):
         """
             one-state with self loop FST which including all words.
         """
-        in_syms = self.word_tb
-        out_syms = self.word_tb
         _sigma_star = pynini.Fst()
         _sigma_star.add_state() # 0-state
         _arc_weight = pynini.Weight("tropical", 0)
 
-        for key in self.word_tb.keys():
-            _arc_in = int(in_syms[key])
-            _arc_out = int(out_syms[key])
+        for _arc_in in self.sigma_alphabet():
+            _arc_out = _arc_in
             _sigma_star.add_arc(0, pynini.Arc(_arc_in, _arc_out, _arc_weight, 0))
         
         _sigma_star.set_start(0)
@@ -357,15 +376,12 @@ class TagHelper(GrammarHelper):
         """
             two-states FST which including all words.
         """
-        in_syms = self.word_tb
-        out_syms = self.word_tb
         _sigma_star = pynini.Fst()
         _sigma_star.add_states(2) # 0 and 1 state
         _arc_weight = pynini.Weight("tropical", 0)
 
-        for key in self.word_tb.keys():
-            _arc_in = int(in_syms[key])
-            _arc_out = int(out_syms[key])
+        for _arc_in in self.sigma_alphabet():
+            _arc_out = _arc_in
             _sigma_star.add_arc(0, pynini.Arc(_arc_in, _arc_out, _arc_weight, 1))
 
         _sigma_star.set_start(0)
@@ -377,15 +393,13 @@ class TagHelper(GrammarHelper):
         """
             one-state with self loop FST which including all words.
         """
-        in_syms = self.word_tb
         out_syms = self.word_tb
         _sigma_star = pynini.Fst()
         _sigma_star.add_state() # 0-state
         _arc_weight = pynini.Weight("tropical", 0)
 
-        for key in self.word_tb.keys():
-            _arc_in = int(in_syms[key])
-            _arc_out = int(out_syms["<eps>"])
+        for _arc_in in self.sigma_alphabet():
+            _arc_out = out_syms["<eps>"]
             _sigma_star.add_arc(0, pynini.Arc(_arc_in, _arc_out, _arc_weight, 0))
         
         _sigma_star.set_start(0)
@@ -397,15 +411,13 @@ class TagHelper(GrammarHelper):
         """
             two-states FST which including all words.
         """
-        in_syms = self.word_tb
         out_syms = self.word_tb
         _sigma_star = pynini.Fst()
         _sigma_star.add_states(2) # 0 and 1 state
         _arc_weight = pynini.Weight("tropical", 0)
 
-        for key in self.word_tb.keys():
-            _arc_in = int(in_syms[key])
-            _arc_out = int(out_syms["<eps>"])
+        for _arc_in in self.sigma_alphabet():
+            _arc_out = out_syms["<eps>"]
             _sigma_star.add_arc(0, pynini.Arc(_arc_in, _arc_out, _arc_weight, 1))
 
         _sigma_star.set_start(0)
@@ -413,6 +425,7 @@ class TagHelper(GrammarHelper):
 
         return _sigma_star
     
+    @metrics.timed("read_tag_grammar")
     def read_tag_grammar(self, x, write_words=None):
         """
             reading grammar file and then return grammar fst
@@ -439,13 +452,9 @@ class TagHelper(GrammarHelper):
                 elif re.search("<.*>", j) and j != "<SIGMA_STAR>" and j != "<s>" and j != "</s>":
                     _temp = pynini.Fst()
                     _temp.add_states(2)
-                    _arc_in = int(in_syms["<eps>"])
+                    _arc_in = in_syms["<eps>"]
 
-                    try:
-                        _arc_out = int(out_syms[j])
-                    except:
-                        out_syms.update({j: str(len(out_syms.keys()))})
-                        _arc_out = int(out_syms[j])
+                    _arc_out = out_syms.add_symbol(j)
                     
                     _temp.add_arc(0, pynini.Arc(_arc_in, _arc_out, _arc_weight, 1))
                     _temp.set_start(0)
@@ -454,8 +463,8 @@ class TagHelper(GrammarHelper):
 
                 else:
                     try:
-                        _arc_in = int(in_syms[j])
-                        _arc_out = int(out_syms[j])
+                        _arc_in = in_syms[j]
+                        _arc_out = out_syms[j]
                     except:
                         raise ValueError(j, "is not in symbol tables")
                     
@@ -467,8 +476,8 @@ class TagHelper(GrammarHelper):
                     _gfst = _gfst + _temp
 
             # go back to state-0
-            _arc_in = int(in_syms["<eps>"])
-            _arc_out = int(out_syms["<eps>"])
+            _arc_in = in_syms["<eps>"]
+            _arc_out = out_syms["<eps>"]
             cur_state = _gfst.num_states() - 1
             _gfst.add_arc(cur_state, pynini.Arc(_arc_in, _arc_out, _arc_weight, 0))
             _gfst.set_final(0)
@@ -482,6 +491,7 @@ class TagHelper(GrammarHelper):
 
         return _grammar_fst.optimize()
     
+    @metrics.timed("read_sub_graph_grammar")
     def read_sub_graph_grammar(self, x):
         """
             reading grammar file and then return sub-graph grammar fst which will be used in Fst's intersection
@@ -508,16 +518,12 @@ class TagHelper(GrammarHelper):
                 elif re.search("<.*>", j) and j != "<SIGMA_STAR>" and j != "<s>" and j != "</s>":
                     _temp = pynini.Fst()
                     _temp.add_states(2)
-                    _arc_in = int(in_syms["<eps>"])
+                    _arc_in = in_syms["<eps>"]
                     # no show <tag> in sub-graph
-                    _arc_out = int(out_syms["<eps>"])
+                    _arc_out = out_syms["<eps>"]
                     
                     # # show <tag> in sub-graph
-                    # try:
-                    #     _arc_out = int(out_syms[j])
-                    # except:
-                    #     out_syms.update({j: str(len(out_syms.keys()))})
-                    #     _arc_out = int(out_syms[j])
+                    # _arc_out = out_syms.add_symbol(j)
                     
                     _temp.add_arc(0, pynini.Arc(_arc_in, _arc_out, _arc_weight, 1))
                     _temp.set_start(0)
@@ -526,8 +532,8 @@ class TagHelper(GrammarHelper):
                 
                 else:
                     try:
-                        _arc_in = int(in_syms[j])
-                        _arc_out = int(out_syms["<eps>"])
+                        _arc_in = in_syms[j]
+                        _arc_out = out_syms["<eps>"]
                     except:
                         raise ValueError(j, "is not in symbol tables")
                     
@@ -539,41 +545,62 @@ class TagHelper(GrammarHelper):
                     _gfst = _gfst + _temp
 
             # go back to state-0
-            _arc_in = int(in_syms["<eps>"])
-            _arc_out = int(out_syms["<eps>"])
+            _arc_in = in_syms["<eps>"]
+            _arc_out = out_syms["<eps>"]
             cur_state = _gfst.num_states() - 1
             _gfst.add_arc(cur_state, pynini.Arc(_arc_in, _arc_out, _arc_weight, 0))
             _gfst.set_final(0)
             _grammar_fst.union(_gfst)
 
         return _grammar_fst.optimize()
-    
-    def generate_replace_fst(self, fst_in, nonterminal_in, nonterminal_out, syms_tb):
+
+    def grammar_anchors(self, x):
+        """
+            see read_grammar_anchors()
+        """
+        return read_grammar_anchors(x, self.word_tb)
+
+    @metrics.timed("generate_replace_fst", fst_in=1)
+    def generate_replace_fst(self, fst_in, nonterminal_in, nonterminal_out, syms_tb, nshortest=1):
+        """
+            Args:
+                fst_in: NE result fst
+                nshortest: if > 1, replace with the n best NE paths of fst_in, each one weighted by its path weight
+        """
         _arc_weight = pynini.Weight("tropical", 0)
 
-        fst_in_seq = fst_to_linear_sequence(fst_in)
-        ne_fst = pynini.Fst()
-        ne_fst.add_state()
-        ne_fst.set_start(0)
-        ne_fst.set_final(0)
+        if nshortest > 1:
+            ne_seqs = nbest_paths(fst_in, nshortest=nshortest)
+        else:
+            ne_seqs = [ best_path(fst_in) ]
 
-        for i in fst_in_seq.split():
-            _fst = self.pair2fst(["0", i])
-            ne_fst = ne_fst + _fst
+        ne_fst = pynini.Fst()
+        for labels, weight in ne_seqs:
+            _ne_fst = pynini.Fst()
+            _ne_fst.add_state()
+            _ne_fst.set_start(0)
+            _ne_fst.set_final(0)
+
+            for i in labels:
+                _fst = self.pair2fst(["0", str(i)])
+                _ne_fst = _ne_fst + _fst
+            if nshortest > 1:
+                _ne_fst = _ne_fst + pynini.accep("", weight=weight)
+            ne_fst.union(_ne_fst)
         ne_fst.optimize()
 
         terminal_in_fst = pynini.Fst()
         terminal_in_fst.add_states(2)
-        _arc_in = int(syms_tb[nonterminal_in])
-        _arc_out = int(syms_tb["<eps>"])
+        _arc_in = syms_tb[nonterminal_in]
+        _arc_out = syms_tb["<eps>"]
         terminal_in_fst.add_arc(0, pynini.Arc(_arc_in, _arc_out, _arc_weight, 1))
         terminal_in_fst.set_start(0)
         terminal_in_fst.set_final(1)
 
         terminal_out_fst = pynini.Fst()
         terminal_out_fst.add_states(2)
-        _arc_in = int(syms_tb[nonterminal_out])
-        _arc_out = int(syms_tb["<eps>"])
+        _arc_in = syms_tb[nonterminal_out]
+        _arc_out = syms_tb["<eps>"]
         terminal_out_fst.add_arc(0, pynini.Arc(_arc_in, _arc_out, _arc_weight, 1))
         terminal_out_fst.set_start(0)
         terminal_out_fst.set_final(1)
@@ -1,20 +1,195 @@
 # Copyright 2020 (author: Meng Wu)
 
 import io
+import math
+import weakref
+import collections
 import pynini
-from .utils import DataIO, make_context_fst, update_wd_table
-from .tokenizer import Tokenizer
-from .common import list2fst
+from .utils import DataIO, SymbolTable, update_wd_table
+from .tokenizer import get_tokenizer
+from .common import fst_labels
+from . import metrics
+
+
+# {vocabulary SymbolTable: {non_hot_weight: (fst, arc index)}}, freed together with the table
+_passthrough_cache = weakref.WeakKeyDictionary()
+
+
+def passthrough_fst(wd_table, non_hot_weight=0.1):
+    """
+        identity part of contextFST, one wd:wd loop on state 0 for every word except <eps>.
+        It only depends on the vocabulary, so it is built once per table and shared by all users.
+        Input:
+            wd_table: SymbolTable, must not be changed after the first call
+        Return:
+            fst: shared fst, copy it before any change
+            arcs: dict {wd: arc index on state 0}
+    """
+    cache = _passthrough_cache.setdefault(wd_table, {})
+    if non_hot_weight not in cache:
+        fst = pynini.Fst()
+        fst.add_state()
+        fst.set_start(0)
+        fst.set_final(0)
+        fst.reserve_arcs(0, len(wd_table))
+
+        arcs = {}
+        _non_hot_weight = pynini.Weight("tropical", -math.log(non_hot_weight))
+        for wd, idx in wd_table.items():
+            # avoid epsilon symbols in WFST.
+            if wd != "<eps>":
+                arcs[wd] = fst.num_arcs(0)
+                fst.add_arc(0, pynini.Arc(idx, idx, _non_hot_weight, 0))
+        cache[non_hot_weight] = (fst, arcs)
+
+    return cache[non_hot_weight]
+
+
+def label_grams(labels, order):
+    """
+        Return:
+            set of n-grams (tuple) of a label sequence, the whole sequence if it is shorter than order
+    """
+    labels = tuple(labels)
+    if len(labels) <= order:
+        return { labels }
+
+    return { labels[i:i+order] for i in range(len(labels) - order + 1) }
+
+
+def lattice_grams(x, order, side="output"):
+    """
+        all label sequences of length 1 ~ order found on some path of an acyclic fst, epsilon labels are skipped
+        Return:
+            set of tuple, None if x has cycles
+    """
+    if x.start() == -1:
+        return set()
+    if not x.properties(pynini.ACYCLIC, True):
+        return None
+
+    x = pynini.topsort(x)
+    grams = set()
+    history = collections.defaultdict(set) # {state: last order-1 labels of the paths reaching it}
+    history[x.start()].add(())
+    for state in x.states():
+        for arc in x.arcs(state):
+            label = arc.olabel if side == "output" else arc.ilabel
+            if label == 0:
+                history[arc.nextstate].update(history[state])
+                continue
+
+            for prev in history[state]:
+                seq = prev + (label,)
+                grams.update(seq[i:] for i in range(len(seq)))
+                history[arc.nextstate].add(seq[1:] if len(seq) == order else seq)
+        del history[state]
+
+    return grams
+
+
+class PhoneticIndex():
+    """
+        Inverted index of label n-grams over user entries.
+        SoundsLike and IPA entries are indexed by their phones, context entries by their words,
+        which are matched against the homophone words of the hypothesis phones (Lfst o phones).
+        An entry is retrieved only if all of its n-grams occur in the hypothesis, so the entries which
+        could match are always retrieved and correcting with them gives the same result as the full user graph.
+    """
+    def __init__(self, order=3):
+        self.order = order
+        self.postings = collections.defaultdict(set) # {(space, gram): {(phrase, kind)}}
+        self.sizes = {} # {(phrase, kind): number of distinct grams}
+        self.grams = {}
+        self.stats = {"queries": 0, "retrieved": 0}
+
+    def add(self, phrase, kind, labels):
+        """
+            Args:
+                kind: context (word labels), soundslike or ipa (phone labels)
+        """
+        key = (phrase, kind)
+        space = "word" if kind == "context" else "phone"
+        self.remove(phrase, kind)
+        grams = label_grams(labels, self.order)
+        for gram in grams:
+            self.postings[(space, gram)].add(key)
+        self.sizes[key] = len(grams)
+        self.grams[key] = (space, grams)
+
+    def remove(self, phrase, kind=None):
+        for key in ([ (phrase, kind) ] if kind is not None else [ (phrase, i) for i in ("context", "soundslike", "ipa") ]):
+            if key not in self.grams:
+                continue
+
+            space, grams = self.grams.pop(key)
+            del self.sizes[key]
+            for gram in grams:
+                self.postings[(space, gram)].discard(key)
+                if not self.postings[(space, gram)]:
+                    del self.postings[(space, gram)]
+
+    def query(self, word_grams, phone_grams):
+        """
+            Input:
+                word_grams, phone_grams: lattice_grams() of the hypothesis words and phones
+            Return:
+                list of (phrase, kind)
+        """
+        hits = collections.Counter()
+        for space, grams in [("word", word_grams), ("phone", phone_grams)]:
+            for gram in grams:
+                hits.update(self.postings.get((space, gram), ()))
+
+        result = [ key for key, n in hits.items() if n == self.sizes[key] ]
+        self.stats["queries"] += 1
+        self.stats["retrieved"] += len(result)
+
+        return result
+
+    def query_labels(self, word_labels, phone_labels):
+        """
+            entries whose labels all occur in the hypothesis, for cyclic hypotheses whose n-grams can not be listed
+            Input:
+                word_labels, phone_labels: set of labels of the hypothesis words and phones
+            Return:
+                list of (phrase, kind), a superset of the entries query() would retrieve
+        """
+        labels = {"word": word_labels, "phone": phone_labels}
+        result = [ key for key, (space, grams) in self.grams.items() \
+                    if all(labels[space].issuperset(gram) for gram in grams) ]
+        self.stats["queries"] += 1
+        self.stats["retrieved"] += len(result)
+
+        return result
+
+    def __len__(self):
+        return len(self.sizes)
 
 
 class UserTableReader(DataIO):
     def __init__(self, encode="utf-8", split_space=" ", wd_table_path="test_data/words.txt", \
                     phone_table_path="test_data/phones.txt", zh_syllable_table_path="test_data/zh_syllable.txt"):
+        """
+            Tables could be file paths or preloaded tables shared by many readers (see UserGraphStore),
+            the word table is never changed, user words are added into an overlay of it.
+        """
         super().__init__(encode="utf-8", split_space=" ")
 
-        self.wd_table = self.read_word_table(wd_table_path)
-        self.phone_table = self.read_word_table(phone_table_path)
-        self.zh_syllable_table = self.read_zh_syllable_table(zh_syllable_table_path)
+        if isinstance(wd_table_path, SymbolTable):
+            self.wd_table = SymbolTable(base=wd_table_path)
+        else:
+            self.wd_table = SymbolTable(base=self.read_symbol_table(wd_table_path))
+
+        if isinstance(phone_table_path, SymbolTable):
+            self.phone_table = phone_table_path
+        else:
+            self.phone_table = self.read_symbol_table(phone_table_path)
+
+        if isinstance(zh_syllable_table_path, dict):
+            self.zh_syllable_table = zh_syllable_table_path
+        else:
+            self.zh_syllable_table = self.read_zh_syllable_table(zh_syllable_table_path)
 
     def read_zh_syllable_table(self, x):
         dct = {}
@@ -98,34 +273,85 @@ class UserTableReader(DataIO):
 
         return dct, oov_list
 
+    def write_user_table(self, dct, x):
+        """
+            Write user table read back by read_user_table()
+            Input:
+                dct: user table stored in dict
+                x: string, user_tb path
+        """
+        with io.open(x, "w", encoding=self.encode) as f:
+            f.write("Phrase,SoundsLike,IPA,DisplayAs\n")
+            for phrase, entry in dct.items():
+                f.write(",".join([phrase, entry["SoundsLike"], entry["IPA"], entry["DisplayAs"]]) + "\n")
+
 
 class UserCustomGraph(UserTableReader):
     def __init__(self, user_table, wd_table_path, phone_table_path, zh_syllable_table_path, \
-                    jieba_lex=None, encode="utf-8", split_space=" "):
+                    jieba_lex=None, encode="utf-8", split_space=" ", tokenizer=None):
         """
             wd_table must be as same as decoding graph used.
             Args:
                 user_dct(dict): dct[phrase] = {"SoundsLike": xxx,"IPA": xxx, "DisplayAs": xxx}
-                wd_table(dict): {wd1: int, wd2: int, etc.}
+                wd_table(SymbolTable): {wd1: int, wd2: int, etc.}
+                tokenizer: Tokenizer, shared one instead of loading jieba_lex again
         """
         super().__init__(encode=encode, split_space=split_space, wd_table_path=wd_table_path, \
             phone_table_path=phone_table_path, zh_syllable_table_path=zh_syllable_table_path)
 
         self.user_dct, self.oov_list = self.read_user_table(user_table)
 
-        if jieba_lex is not None:
-            self.tokenizer = Tokenizer(backend="jieba", jieba_dict=jieba_lex) ## need a Jieba dictionay
-        else:
-            self.tokenizer = Tokenizer(backend="jieba")
+        self.jieba_lex = jieba_lex ## need a Jieba dictionay
+        self._tokenizer = tokenizer
+
+        # graphs are built on first use from user_dct, add_entry()/remove_entry() drop them to be rebuilt
+        # layout: state 0 is start and final, each entry is a path 0 -> ... -> 0
+        self.fstC = None
+        self.fstS = None
+        self.fstI = None
+        self.context_weights = (0.9, 0.1)
+        self.version = 0 # bumped by every add_entry()/remove_entry()
+        self.index = None # PhoneticIndex, see build_index()
+
+    @property
+    def tokenizer(self):
+        # loaded on first use, only phrases which are not a word are segmented
+        if self._tokenizer is None:
+            self._tokenizer = get_tokenizer(backend="jieba", jieba_dict=self.jieba_lex)
+
+        return self._tokenizer
+
+    def unsegmented_phrases(self):
+        """
+            Return:
+                context phrases which are not a word of wd_table and must be segmented
+        """
+        return [ phrase for phrase in self.user_dct.keys() \
+                    if phrase not in self.wd_table and self.user_dct[phrase]["DisplayAs"] != "" ]
+
+    def segment_phrases(self):
+        # segment all phrases in one call, context_path() then reads them from the tokenizer cache
+        phrases = self.unsegmented_phrases()
+        if phrases:
+            self.tokenizer.segment_batch(phrases)
 
     def contextFST(self):
-        return self.get_contextFST()
+        if self.fstC is None:
+            self.fstC = self.get_contextFST()
+
+        return self.fstC
     
     def soundslikeFST(self):
-        return self.get_soundslikeFST()
+        if self.fstS is None:
+            self.fstS = self.get_soundslikeFST()
+
+        return self.fstS
     
     def ipaFST(self):
-        return self.get_ipaFST()
+        if self.fstI is None:
+            self.fstI = self.get_ipaFST()
+
+        return self.fstI
     
     def word_table(self, write_words=None):
         new_words_table = update_wd_table(self.wd_table, self.oov_list)
@@ -138,97 +364,278 @@ class UserCustomGraph(UserTableReader):
 
         return new_words_table
 
+    def new_loop_fst(self):
+        fst = pynini.Fst()
+        fst.add_state()
+        fst.set_start(0)
+        fst.set_final(0)
+
+        return fst
+
+    def add_path(self, fst, in_labels, out_label, weight):
+        """
+            add path 0 -> ... -> 0 reading in_labels, out_label is written on the first arc
+            Return:
+                index of the first arc on state 0
+        """
+        idx = fst.num_arcs(0)
+        cur_state = 0
+        for i, label in enumerate(in_labels):
+            if i == len(in_labels) - 1:
+                next_state = 0
+            else:
+                next_state = fst.add_state()
+            fst.add_arc(cur_state, pynini.Arc(label, out_label if i == 0 else 0, weight, next_state))
+            cur_state = next_state
+
+        return idx
+
+    def delete_arcs(self, fst, indices):
+        """
+            delete arcs of state 0 by index, each one is overwritten by the last arc which is then dropped,
+            so the order of the other arcs is not kept
+        """
+        for idx in sorted(indices, reverse=True):
+            last = fst.num_arcs(0) - 1
+            if idx != last:
+                aiter = fst.mutable_arcs(0)
+                aiter.seek(last)
+                arc = aiter.value()
+                aiter.seek(idx)
+                aiter.set_value(arc)
+            fst.delete_arcs(0, 1)
+
+    def context_path(self, phrase):
+        """
+            Return:
+                word labels of phrase, phrase is segmented if it is not a word
+        """
+        if phrase in self.wd_table:
+            phrase_inside = [ phrase ]
+        else:
+            phrase_inside = self.tokenizer.segment(phrase).split()
+
+        return [ self.wd_table[wd] for wd in phrase_inside ]
+
+    def soundslike_path(self, phrase):
+        """
+            Return:
+                phone labels of SoundsLike, None if some syllable is unknown
+        """
+        phone_seq = []
+        for syllable in self.user_dct[phrase]["SoundsLike"].split("-"):
+            if syllable not in self.zh_syllable_table:
+                return None
+            phone_seq += self.zh_syllable_table[syllable].split()
+
+        return [ self.phone_table[phone] for phone in phone_seq ]
+
+    def ipa_path(self, phrase):
+        """
+            Return:
+                phone labels of IPA, None if some phone is not in phones.txt
+        """
+        ipa_list = self.user_dct[phrase]["IPA"].split(" ")
+        # check phoneme in phones.txt
+        for phone in ipa_list:
+            if phone not in self.phone_table:
+                print("this line {ipa_str} in {phrase}:IPA is illagel".format(ipa_str=self.user_dct[phrase]["IPA"], phrase=phrase))
+                return None
+
+        return [ self.phone_table[phone] for phone in ipa_list ]
+
+    def check_indexed(self):
+        if self.index is None:
+            raise RuntimeError("add_entry()/remove_entry() are only followed by the candidate pipeline, " \
+                                "call build_index() first (load_pipeline(config, candidates=True) does)")
+
+    def changed(self):
+        """
+            drop the built graphs, they are rebuilt from user_dct on next contextFST()/soundslikeFST()/ipaFST()
+        """
+        self.fstC = None
+        self.fstS = None
+        self.fstI = None
+        self.version += 1
+
+    def add_entry(self, phrase, soundslike="", ipa="", displayas=""):
+        """
+            add or update one user entry, the phonetic index is updated in place.
+            Only the candidate pipeline follows it (BrowniePipeline with user_custom), graphs composed before
+            from contextFST()/soundslikeFST()/ipaFST() are not changed, those are rebuilt on their next call.
+        """
+        self.check_indexed()
+        if phrase == "":
+            raise TypeError("Phrase must be given.")
+        if soundslike != "":
+            for syllable in soundslike.split("-"):
+                if self.is_oov(syllable, check_type="syllable"):
+                    raise TypeError("illagle syllables in SoundsLike." + " " + ",".join([phrase, soundslike, ipa, displayas]))
+
+        if phrase in self.user_dct:
+            self.remove_entry(phrase)
+
+        if displayas == "":
+            displayas = phrase
+        self.user_dct[phrase] = {"SoundsLike": soundslike, "IPA": ipa, "DisplayAs": displayas}
+        if self.is_oov(displayas, check_type="word"):
+            self.oov_list.append(displayas)
+            self.word_table()
+
+        self.index_entry(phrase)
+        self.changed()
+
+    def remove_entry(self, phrase):
+        """
+            remove one user entry, see add_entry()
+        """
+        self.check_indexed()
+        del self.user_dct[phrase]
+        self.index.remove(phrase)
+        self.changed()
+
+    def index_entry(self, phrase):
+        entry = self.user_dct[phrase]
+        if entry["DisplayAs"] != "":
+            self.index.add(phrase, "context", self.context_path(phrase))
+        for kind, get_path in [("soundslike", self.soundslike_path), ("ipa", self.ipa_path)]:
+            if entry["SoundsLike" if kind == "soundslike" else "IPA"] != "":
+                in_labels = get_path(phrase)
+                if in_labels is not None:
+                    self.index.add(phrase, kind, in_labels)
+
+    def build_index(self, order=3):
+        """
+            index all entries by phone and word n-grams, kept up to date by add_entry()/remove_entry()
+            Return:
+                PhoneticIndex
+        """
+        self.word_table()
+        self.index = PhoneticIndex(order)
+        self.segment_phrases()
+        for phrase in self.user_dct.keys():
+            self.index_entry(phrase)
+
+        return self.index
+
+    def candidate_graphs(self, words, phones):
+        """
+            tiny per-request user graphs built only from the entries retrieved by the index
+            Input:
+                words: homophone word lattice of the hypothesis (phone-in/wd-out)
+                phones: phone lattice of the hypothesis (wd-in/phone-out)
+            Return:
+                dict {"context": wd-in/wd-out, "soundslike": ph-in/wd-out, "ipa": ph-in/wd-out}, ilabel sorted.
+                words o context, phones o soundslike and phones o ipa are the three parts of
+                phones o user_graph.
+        """
+        if self.index is None:
+            self.build_index()
+        word_grams = lattice_grams(words, self.index.order)
+        phone_grams = lattice_grams(phones, self.index.order)
+        if word_grams is None or phone_grams is None:
+            # cyclic hypothesis, entries are retrieved by the labels it contains
+            word_labels = fst_labels(words, "output") - {0}
+            retrieved = self.index.query_labels(word_labels, fst_labels(phones, "output") - {0})
+        else:
+            word_labels = { gram[0] for gram in word_grams if len(gram) == 1 }
+            retrieved = self.index.query(word_grams, phone_grams)
+
+        wd_table = self.wd_table
+        hot_weight, non_hot_weight = self.context_weights
+        graphs = { kind: self.new_loop_fst() for kind in ("context", "soundslike", "ipa") }
+
+        # passthrough of the hypothesis words only, user phrases are disabled in the full contextFST too
+        _non_hot_weight = -math.log(non_hot_weight)
+        for label in sorted(word_labels):
+            wd = wd_table.get_symbol(label)
+            if wd not in self.user_dct and wd in wd_table.base:
+                graphs["context"].add_arc(0, pynini.Arc(label, label, _non_hot_weight, 0))
+
+        for phrase, kind in retrieved:
+            out_label = wd_table[self.user_dct[phrase]["DisplayAs"]]
+            if kind == "context":
+                self.add_path(graphs[kind], self.context_path(phrase), out_label, -math.log(hot_weight))
+            else:
+                in_labels = self.soundslike_path(phrase) if kind == "soundslike" else self.ipa_path(phrase)
+                self.add_path(graphs[kind], in_labels, out_label, 0)
+
+        for fst in graphs.values():
+            fst.arcsort("ilabel")
+
+        return graphs
+
+    @metrics.timed("contextFST")
     def get_contextFST(self, hot_weight=0.9, non_hot_weight=0.1):
         """
             as same as building context C.fst.txt
+            The vocabulary passthrough is copied from the shared passthrough_fst() and the arcs of
+            the user phrases are deleted from it, only the hotword paths are built here.
             Fst type:
                 word-in / word-out
             Return:
-                C: list, will be called by _get_contextFST()
+                C: fst, hotword paths with weight hot_weight and non-hotword passthrough with non_hot_weight
         """
         user_dct = self.user_dct
         wd_table = self.wd_table
-        context_lex_form = []
+        self.context_weights = (hot_weight, non_hot_weight)
+        self.word_table()
+        shared_fst, passthrough_arcs = passthrough_fst(wd_table.base, non_hot_weight)
+        fst = shared_fst.copy()
+        # user phrases are only reachable through their hotword paths
+        self.delete_arcs(fst, [ passthrough_arcs[phrase] for phrase in user_dct.keys() if phrase in passthrough_arcs ])
+
+        self.segment_phrases()
 
-        # working on user-hotword.
         for _, phrase in enumerate(user_dct.keys()):
+            # working on user-hotword.
             if user_dct[phrase]["DisplayAs"] != "":
-                try:
-                    wd_table[phrase]
-                    phrase_inside = phrase
-                except:
-                    phrase_inside = self.tokenizer.segment(phrase)
-                _c = " ".join([user_dct[phrase]["DisplayAs"], str(hot_weight), phrase_inside])
-                context_lex_form.append(_c.split())
-        
-        # working on non-hotword.
-        for _, wd in enumerate(wd_table.keys()):
-            # avoid epsilon symbols in WFST.
-            if wd != "<eps>":
-                if wd not in user_dct.keys():
-                    _c = " ".join([wd, str(non_hot_weight), wd])
-                    context_lex_form.append(_c.split())
-        
-        return list2fst(make_context_fst(context_lex_form), self.word_table(), self.word_table())
+                self.add_path(fst, self.context_path(phrase), wd_table[user_dct[phrase]["DisplayAs"]], -math.log(hot_weight))
+
+        return fst
     
+    @metrics.timed("soundslikeFST")
     def get_soundslikeFST(self):
         """
             build like lexicon.txt, but used non-position dependent phones and no pronunciation weight
             Fst type:
                 phone-in / word-out
             Return:
-                P: list, will be called by _get_contextFST()
+                P: fst
         """
         user_dct = self.user_dct
-        zh_syllable_table = self.zh_syllable_table
-        soundslike_lex = []
-        fake_weight = 0.
+        self.word_table()
+        fst = self.new_loop_fst()
+
         for _, phrase in enumerate(user_dct.keys()):
             if user_dct[phrase]["SoundsLike"] != "":
-                try:
-                    syllable_list = user_dct[phrase]["SoundsLike"].split("-")
-                    phone_seq = ""
-                    for j in syllable_list:
-                        phone_seq += zh_syllable_table[j]
-                        phone_seq += " "
-                        _c = " ".join([user_dct[phrase]["DisplayAs"], str(fake_weight), phone_seq])                   
-
-                except:
+                in_labels = self.soundslike_path(phrase)
+                if in_labels is None:
                     continue
 
-                soundslike_lex.append(_c.split())
+                self.add_path(fst, in_labels, self.wd_table[user_dct[phrase]["DisplayAs"]], 0)
 
-        return list2fst(make_context_fst(soundslike_lex, weight=False), self.phone_table, self.word_table())
+        return fst
 
+    @metrics.timed("ipaFST")
     def get_ipaFST(self):
         """
             build like lexicon.txt, but used non-position dependent phones and no pronunciation weight
             Fst type:
                 phone-in / word-out
             Return:
-                P: list, will be called by _get_contextFST()
+                P: fst
         """
         user_dct = self.user_dct
-        phone_dct = self.phone_table
-        ipa_lex = []
-        fake_weight = 0.
+        self.word_table()
+        fst = self.new_loop_fst()
+
         for _, phrase in enumerate(user_dct.keys()):
             if user_dct[phrase]["IPA"] != "":
-                ipa_list = user_dct[phrase]["IPA"].split(" ")
-                
-                # check phoneme in phones.txt
-                try:
-                    for phone in ipa_list:
-                        _ = phone_dct[phone]
-                    
-                    _c = " ".join([user_dct[phrase]["DisplayAs"], str(fake_weight), user_dct[phrase]["IPA"]])
-                    ipa_lex.append(_c.split())
-
-                except:
-                    print("this line {ipa_str} in {phrase}:IPA is illagel".format(ipa_str=user_dct[phrase]["IPA"], phrase=phrase))
+                in_labels = self.ipa_path(phrase)
+                if in_labels is None:
                     continue
-        
-        if ipa_lex != []:
-            return list2fst(make_context_fst(ipa_lex, weight=False), self.phone_table, self.word_table())
-        else:
-            return list2fst(None, self.phone_table, self.word_table())
+
+                self.add_path(fst, in_labels, self.wd_table[user_dct[phrase]["DisplayAs"]], 0)
+
+        return fst
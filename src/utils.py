@@ -1,7 +1,172 @@
 # Copyright 2020 (author: Meng Wu)
 
 import io
-import math
+import os
+import hashlib
+import itertools
+from array import array
+import pynini
+
+
+# {(path, size, mtime): sha1}, see file_hash()
+_file_hashes = {}
+
+
+def file_hash(x):
+    """
+        sha1 of file content, memorized by (path, size, mtime)
+    """
+    stat = os.stat(x)
+    memo_key = (os.path.abspath(x), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        h = hashlib.sha1()
+        with io.open(x, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        _file_hashes[memo_key] = h.hexdigest()
+
+    return _file_hashes[memo_key]
+
+
+class SymbolTable():
+    """
+        Bidirectional symbol table with int ids.
+        Forward (symbol -> id) and reverse (id -> symbol) maps are kept together,
+        so conversion in both directions is one dict lookup without any rebuild or int() parsing.
+        Read access is dict-like: table[symbol] return int id.
+        With base given the table is an overlay: lookups fall back to base, only the symbols added
+        here are stored, so many tables can extend one shared vocabulary without copying it.
+    """
+    def __init__(self, symbols=None, base=None):
+        """
+            symbols: dict {symbol: idx}, idx could be int or string
+            base: SymbolTable, read-only parent table
+        """
+        self.sym2id = {}
+        self.id2sym = {}
+        self.base = base
+        self.next_id = 0 if base is None else base.next_id
+
+        if symbols is not None:
+            for key, idx in symbols.items():
+                self.add_symbol(key, int(idx))
+
+    def add_symbol(self, symbol, idx=None):
+        """
+            add symbol and return its id, new id is max id + 1 if not given
+        """
+        if symbol in self.sym2id:
+            return self.sym2id[symbol]
+        if self.base is not None and symbol in self.base:
+            return self.base[symbol]
+
+        if idx is None:
+            idx = self.next_id
+        elif self.has_id(idx):
+            raise ValueError("id {} of {} is already used by {}".format(idx, symbol, self.get_symbol(idx)))
+        self.sym2id[symbol] = idx
+        self.id2sym[idx] = symbol
+        if idx >= self.next_id:
+            self.next_id = idx + 1
+
+        return idx
+
+    def remove_symbol(self, symbol):
+        """
+            only the symbols owned by this table can be removed, base is never changed
+        """
+        idx = self.sym2id.pop(symbol)
+        del self.id2sym[idx]
+
+    def get_id(self, symbol):
+        return self[symbol]
+
+    def get(self, symbol, default=None):
+        if symbol in self.sym2id:
+            return self.sym2id[symbol]
+        if self.base is not None:
+            return self.base.get(symbol, default)
+
+        return default
+
+    def has_id(self, idx):
+        return idx in self.id2sym or (self.base is not None and self.base.has_id(idx))
+
+    def get_symbol(self, idx):
+        if idx in self.id2sym or self.base is None:
+            return self.id2sym[idx]
+
+        return self.base.get_symbol(idx)
+
+    def update(self, dct):
+        for key, idx in dct.items():
+            self.add_symbol(key, int(idx))
+
+    def copy(self):
+        """
+            copy own symbols, an overlay copy keeps sharing the same base
+        """
+        table = SymbolTable(base=self.base)
+        table.sym2id = dict(self.sym2id)
+        table.id2sym = dict(self.id2sym)
+        table.next_id = self.next_id
+
+        return table
+
+    def own_items(self):
+        """
+            symbols stored in this table, without the base ones
+        """
+        return self.sym2id.items()
+
+    def keys(self):
+        if self.base is None:
+            return self.sym2id.keys()
+
+        return itertools.chain(self.base.keys(), self.sym2id.keys())
+
+    def values(self):
+        if self.base is None:
+            return self.sym2id.values()
+
+        return itertools.chain(self.base.values(), self.sym2id.values())
+
+    def items(self):
+        if self.base is None:
+            return self.sym2id.items()
+
+        return itertools.chain(self.base.items(), self.sym2id.items())
+
+    def to_pynini(self, name="symbols"):
+        table = pynini.SymbolTable(name)
+        for symbol, idx in sorted(self.items(), key=lambda x: x[1]):
+            table.add_symbol(symbol, idx)
+
+        return table
+
+    @classmethod
+    def from_pynini(cls, x):
+        table = cls()
+        for idx, symbol in x:
+            table.add_symbol(symbol, idx)
+
+        return table
+
+    def __getitem__(self, symbol):
+        if symbol in self.sym2id or self.base is None:
+            return self.sym2id[symbol]
+
+        return self.base[symbol]
+
+    def __contains__(self, symbol):
+        return symbol in self.sym2id or (self.base is not None and symbol in self.base)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.sym2id) + (0 if self.base is None else len(self.base))
+
 
 class DataIO():
     def __init__(self, encode="utf-8", split_space=" "):
@@ -19,6 +184,18 @@ class DataIO():
                     dct.update({key: idx})
         
         return dct
+
+    def read_symbol_table(self, x):
+        """
+            read Kaldi's words.txt/phones.txt as SymbolTable
+        """
+        table = SymbolTable()
+        with io.open(x, "r", encoding=self.encode) as f:
+            for line in f:
+                key, idx = line.strip().split(self.split_space)
+                table.add_symbol(key, int(idx))
+
+        return table
     
     def read_file_to_dict(self, x):
         dct = {}
@@ -30,6 +207,14 @@ class DataIO():
             
         return dct
 
+    def iter_file_lines(self, x):
+        """
+            streaming version of read_file_to_list, yield one split line at a time
+        """
+        with io.open(x, 'r', encoding=self.encode) as f:
+            for line in f:
+                yield line.strip().split(self.split_space)
+
     def read_file_to_list(self, x):
         with io.open(x, 'r', encoding=self.encode) as f:
             result=[ i.strip().split(self.split_space) for i in f.readlines() ]
@@ -81,85 +266,34 @@ def lex_add_disambig(x):
 def update_wd_table(wd_table, oov_list):
     """
         Input:
-            wd_table: dict
+            wd_table: SymbolTable or dict
             oov_list: list
             write: string path
         Return:
-            new_wd_table: dict
+            new_wd_table: SymbolTable or dict
     """
     if isinstance(oov_list, str):
         raise TypeError("need a list")
 
     for i in oov_list:
-        try:
-            # avoid repeatedly update inside class method
-            wd_table[i]
+        # avoid repeatedly update inside class method
+        if i in wd_table:
             continue
 
-        except KeyError:
+        if isinstance(wd_table, SymbolTable):
+            wd_table.add_symbol(i)
+        else:
             wd_table.update({i: str(len(wd_table.keys()))})
 
     return wd_table
 
 
-def make_context_fst(x, weight=True):
-    """
-    read a Kaldi lexicon format list.
-        <word1> <weight> <sub-word1> <sub-word2> <...>
-        example:
-            ABABA 1.0 ABABA
-            ABACHA 1.0 ABACHA
-            每日一物 100 每 日 一 物
-            每日一物 100 每日 一物
-    Returns:
-        List with FST format.
-    """
-    C = x
-    C_fst = []
-    state = int(0)
-    if weight:
-        for i in range(len(C)):
-            if len(C[i]) == 3:
-                logprob = '%.10f' % (-math.log(float(C[i][1])))
-                C_fst.append(['0', '0', C[i][2], C[i][0], logprob])
-            else:
-                logprob = '%.10f' % (-math.log(float(C[i][1])))
-                for j in range(len(C[i]) - 2):
-                    if j == 0:
-                        C_fst.append(['0', '%s' %  (state + 1), C[i][j+2], C[i][0], logprob])
-                        state = state + 1
-                    elif j == len(C[i]) - 3:
-                        C_fst.append(['%s' % state, '0', C[i][j+2], '<eps>'])
-                    else:
-                        C_fst.append(['%s' % state, '%s' % (state + 1), C[i][j+2], '<eps>'])
-                        state = state + 1
-        C_fst.append(['0','0']) # add end
-    
-    else:
-        for i in range(len(C)):
-            if len(C[i]) == 3:
-                C_fst.append(['0', '0', C[i][2], C[i][0]])
-            else:
-                for j in range(len(C[i]) - 2):
-                    if j == 0:
-                        C_fst.append(['0', '%s' %  (state + 1), C[i][j+2], C[i][0]])
-                        state = state + 1
-                    elif j == len(C[i]) - 3:
-                        C_fst.append(['%s' % state, '0', C[i][j+2], '<eps>'])
-                    else:
-                        C_fst.append(['%s' % state, '%s' % (state + 1), C[i][j+2], '<eps>'])
-                        state = state + 1
-        C_fst.append(['0','0']) # add end
-
-    return C_fst
-
-
 def sym2int(x, syms_table):
     """
         convert string to int sequence
         Input:
             x: string
-            syms_table: dict
+            syms_table: SymbolTable or dict
     """
 
     x = x.strip().split()
@@ -181,16 +315,20 @@ def int2sym(x, syms_table):
         convert int sequence to string
         Input:
             x: string
-            syms_table: dict
+            syms_table: SymbolTable or dict
     """
-    syms_table = {v: k for k, v in syms_table.items()}
+    if isinstance(syms_table, SymbolTable):
+        lookup = syms_table.get_symbol
+        x = [ int(i) for i in x.strip().split() ]
+    else:
+        lookup = {v: k for k, v in syms_table.items()}.__getitem__
+        x = x.strip().split()
 
-    x = x.strip().split()
     result = []
     
     try:
         for _, i in enumerate(x):
-            x_sym = str(syms_table[i])
+            x_sym = str(lookup(i))
             result.append(x_sym)
     
         return " ".join(result)